@@ -0,0 +1,88 @@
+__author__ = 'Kelvin'
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+
+# Cache of the GCSFileStat of a file id, so a download can skip the datastore
+# get and the gcs HEAD. The stat carries the object name, content type, size,
+# etag and, in its metadata, the original file name. Uploads and deletes made
+# by this instance invalidate both tiers; changes made by other instances only
+# reach the in-process tier once its entries expire. Entries can be stale, so
+# anything that has to match the object, like ranges and validators, should
+# check the etag against gcs first.
+#
+# An invalidated memcache entry is locked for a while, so a reader that got
+# its stat before the invalidation can't write it back.
+
+_NAMESPACE = 'gcs-file-stat'
+_MEMCACHE_SECONDS = 60 * 60
+_INVALIDATE_LOCK_SECONDS = 30
+_LOCAL_SECONDS = 60
+_LOCAL_MAX_ENTRIES = 1000
+
+_local = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def get(file_id):
+  """Return the cached GCSFileStat of a file id, or None."""
+  key = str(file_id)
+  with _lock:
+    entry = _local.pop(key, None)
+    if entry and entry[0] > time.time():
+      # re-insert so the least recently used entry is always first
+      _local[key] = entry
+      return entry[1]
+  stat = memcache.get(key, namespace=_NAMESPACE)
+  if stat is not None:
+    _put_local(key, stat)
+  return stat
+
+
+def put(file_id, stat):
+  """Cache the GCSFileStat of a file id, unless it was just invalidated.
+
+  An existing entry with another etag is only replaced if it was not
+  invalidated in the meantime.
+
+  Returns:
+    True if the stat was cached.
+  """
+  key = str(file_id)
+  client = memcache.Client()
+  cached = client.gets(key, namespace=_NAMESPACE)
+  if cached is None:
+    stored = client.add(key, stat, time=_MEMCACHE_SECONDS, namespace=_NAMESPACE)
+  elif cached.etag != stat.etag:
+    stored = client.cas(key, stat, time=_MEMCACHE_SECONDS, namespace=_NAMESPACE)
+  else:
+    stored = True
+  if stored:
+    _put_local(key, stat)
+  else:
+    with _lock:
+      _local.pop(key, None)
+  return stored
+
+
+def invalidate(file_id):
+  invalidate_multi([file_id])
+
+
+def invalidate_multi(file_ids):
+  keys = [str(file_id) for file_id in file_ids]
+  with _lock:
+    for key in keys:
+      _local.pop(key, None)
+  memcache.delete_multi(keys, seconds=_INVALIDATE_LOCK_SECONDS, namespace=_NAMESPACE)
+
+
+def _put_local(key, stat):
+  with _lock:
+    _local.pop(key, None)
+    _local[key] = (time.time() + _LOCAL_SECONDS, stat)
+    while len(_local) > _LOCAL_MAX_ENTRIES:
+      _local.popitem(last=False)
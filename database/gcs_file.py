@@ -2,6 +2,8 @@ __author__ = 'Kelvin'
 
 from google.appengine.ext import ndb
 
+from database.gcs_file_name import GCSFileName
+
 
 class GCSFile(ndb.Model):
   gcs_file_name = ndb.StringProperty(required=True)
@@ -21,7 +23,44 @@ class GCSFile(ndb.Model):
     # return key.get()
     return cls.get_by_id(id, ndb.Key('App', 'deepSpace9'))
 
+  @classmethod
+  def get_multi(cls, ids):
+    parent = ndb.Key('App', 'deepSpace9')
+    return ndb.get_multi([ndb.Key(cls, id, parent=parent) for id in ids])
+
   @classmethod
   def get_by_gcs_file_name(cls, gcs_file_name):
-    files = cls.query(cls.gcs_file_name == gcs_file_name)
-    return list(files)
+    return cls.get_by_gcs_file_name_async(gcs_file_name).get_result()
+
+  @classmethod
+  @ndb.tasklet
+  def get_by_gcs_file_name_async(cls, gcs_file_name):
+    # keyed lookups through the GCSFileName index instead of a query
+    file_name = yield GCSFileName.key_for(gcs_file_name).get_async()
+    if file_name is not None:
+      db_gcs_file = yield cls.get_by_id_async(file_name.file_id, ndb.Key('App', 'deepSpace9'))
+      raise ndb.Return(db_gcs_file)
+    # files uploaded before the index existed are found with the old query,
+    # and indexed so the next lookup is keyed
+    query = cls.query(cls.gcs_file_name == gcs_file_name, ancestor=ndb.Key('App', 'deepSpace9'))
+    db_gcs_file = yield query.get_async()
+    if db_gcs_file is not None:
+      yield GCSFileName.save_new(gcs_file_name, db_gcs_file.key.id()).put_async()
+    raise ndb.Return(db_gcs_file)
+
+  @classmethod
+  def index_file_names(cls, cursor=None, batch_size=500):
+    """Migration creating the GCSFileName index of one batch of existing files.
+
+    Args:
+      cursor: the cursor returned by the previous batch, None to start.
+      batch_size: number of GCSFile entities to index in this call.
+
+    Returns:
+      A tuple of (number of files indexed, cursor for the next batch). The
+      cursor is None once every GCSFile has been indexed.
+    """
+    query = cls.query(ancestor=ndb.Key('App', 'deepSpace9'))
+    files, next_cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+    ndb.put_multi([GCSFileName.save_new(f.gcs_file_name, f.key.id()) for f in files])
+    return len(files), next_cursor if more else None
@@ -0,0 +1,29 @@
+__author__ = 'Kelvin'
+
+from hashlib import sha1
+
+from google.appengine.ext import ndb
+
+
+class GCSFileName(ndb.Model):
+  """Index entity pointing from a gcs object name to the id of its GCSFile.
+
+  It is keyed by the object name so looking up the GCSFile of a name is a
+  strongly consistent get that ndb can cache, instead of a query. It is a
+  root entity, so writing it does not add to the App/deepSpace9 entity group
+  every GCSFile is written to.
+  """
+  file_id = ndb.IntegerProperty(required=True, indexed=False)
+
+  @classmethod
+  def key_for(cls, gcs_file_name):
+    if isinstance(gcs_file_name, unicode):
+      gcs_file_name = gcs_file_name.encode('utf-8')
+    # key names are limited to 500 bytes but object names can be up to 1024
+    if len(gcs_file_name) > 500:
+      gcs_file_name = sha1(gcs_file_name).hexdigest()
+    return ndb.Key(cls, gcs_file_name)
+
+  @classmethod
+  def save_new(cls, gcs_file_name, file_id):
+    return cls(key=cls.key_for(gcs_file_name), file_id=file_id)
@@ -22,12 +22,18 @@ from __future__ import with_statement
 
 __all__ = ['copy2',
            'delete',
+           'delete_async',
+           'download_to',
            'listbucket',
            'open',
+           'resume_upload',
            'stat',
+           'write_object',
+           'stat_async',
            'compose',
           ]
 
+import __builtin__
 import logging
 import StringIO
 import urllib
@@ -40,6 +46,10 @@ from . import common
 from . import errors
 from . import storage_api
 
+try:
+  from google.appengine.ext import ndb
+except ImportError:
+  from google.appengine.ext import ndb
 
 
 def open(filename,
@@ -49,7 +59,11 @@ def open(filename,
          read_buffer_size=storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE,
          retry_params=None,
          _account_id=None,
-         offset=0):
+         offset=0,
+         max_readahead=storage_api.ReadBuffer.DEFAULT_MAX_READAHEAD,
+         lazy=False,
+         decode_gzip=False,
+         parallel=None):
   """Opens a Google Cloud Storage file and returns it as a File-like object.
 
   Args:
@@ -66,7 +80,7 @@ def open(filename,
       See https://developers.google.com/storage/docs/reference-headers
       for details.
     read_buffer_size: The buffer size for read. Read keeps a buffer
-      and prefetches another one. To minimize blocking for large files,
+      and prefetches the next ones. To minimize blocking for large files,
       always read by buffer size. To minimize number of RPC requests for
       small files, set a large buffer size. Max is 30MB.
     retry_params: An instance of api_utils.RetryParams for subsequent calls
@@ -74,16 +88,39 @@ def open(filename,
     _account_id: Internal-use only.
     offset: Number of bytes to skip at the start of the file. If None, 0 is
       used.
+    max_readahead: Max bytes read keeps prefetching for sequential reads.
+      The readahead grows from one buffer up to this size while reads stay
+      sequential and shrinks back to one buffer on seek.
+    lazy: If True, reading mode makes no request until the file is first
+      read, its stat is asked for or it is seeked relative to its end. Cheap
+      for handles that may never be read. A missing file is reported then,
+      not here.
+    decode_gzip: If True and the file is stored with content-encoding gzip,
+      reading mode returns a GzipReadBuffer that inflates it as it is read,
+      in read_buffer_size chunks. Other files are read as is. Offsets count
+      decoded bytes, and only reading forward is supported.
+    parallel: If more than 1, writing mode returns a ParallelStreamingBuffer
+      that uploads parts of the file through that many concurrent resumable
+      uploads and composes them on close. Faster for large files, but holds
+      up to parallel + 1 parts of 8MB in memory. Ignored on the dev
+      appserver, which has no compose.
 
   Returns:
     A reading or writing buffer that supports File-like interface. Buffer
-    must be closed after operations are done.
+    must be closed after operations are done. A reading buffer exposes the
+    file's GCSFileStat as its stat attribute, so there is no need to call
+    stat() separately.
 
   Raises:
     errors.AuthorizationError: if authorization failed.
     errors.NotFoundError: if an object that's expected to exist doesn't.
     ValueError: invalid open mode or if content_type or options are specified
-      in reading mode.
+      in reading mode, or offset is used with decode_gzip.
+
+  In writing mode a file of up to 1MB is sent with a single request by close.
+  For a larger one, the request starting a resumable upload is sent once
+  that much is written, without waiting for its response; errors from it
+  are raised by the first flush or by close.
   """
   common.validate_file_path(filename)
   api = storage_api._get_storage_api(retry_params=retry_params,
@@ -92,19 +129,67 @@ def open(filename,
 
   if mode == 'w':
     common.validate_options(options)
+    if (parallel and parallel > 1 and
+        not os.getenv('SERVER_SOFTWARE', '').startswith('Dev')):
+      return storage_api.ParallelStreamingBuffer(api, filename, content_type,
+                                                 options, parallel=parallel)
     return storage_api.StreamingBuffer(api, filename, content_type, options)
   elif mode == 'r':
     if content_type or options:
       raise ValueError('Options and content_type can only be specified '
                        'for writing mode.')
-    return storage_api.ReadBuffer(api,
-                                  filename,
-                                  buffer_size=read_buffer_size,
-                                  offset=offset)
+    if decode_gzip and offset:
+      raise ValueError('Offset can not be used with decode_gzip.')
+    read_buffer = storage_api.ReadBuffer(api,
+                                         filename,
+                                         buffer_size=read_buffer_size,
+                                         offset=offset,
+                                         max_readahead=max_readahead,
+                                         lazy=lazy)
+    if decode_gzip:
+      return storage_api.GzipReadBuffer(read_buffer)
+    return read_buffer
   else:
     raise ValueError('Invalid mode %s.' % mode)
 
 
+def download_to(filename,
+                fileobj_or_path,
+                concurrency=storage_api.ReadBuffer.DEFAULT_DOWNLOAD_CONCURRENCY,
+                chunk_size=storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE,
+                retry_params=None,
+                _account_id=None):
+  """Download a Google Cloud Storage file using parallel range requests.
+
+  Memory use is bounded by concurrency * chunk_size rather than by the size
+  of the file, unlike open(filename).read().
+
+  Args:
+    filename: A Google Cloud Storage filename of form '/bucket/filename'.
+    fileobj_or_path: A local path to write the file to, or a file-like object
+      open for writing. If it supports tell() and seek(), chunks are written
+      at their offsets as they arrive. Otherwise they are written in order.
+    concurrency: Max number of chunks requested at once.
+    chunk_size: Bytes requested by each range request. Max is 30MB.
+    retry_params: An api_utils.RetryParams for this call to GCS. If None,
+      the default one is used.
+    _account_id: Internal-use only.
+
+  Returns:
+    The number of bytes downloaded.
+
+  Raises:
+    errors.AuthorizationError: if authorization failed.
+    errors.NotFoundError: if the file doesn't exist.
+  """
+  with open(filename, 'r', read_buffer_size=chunk_size,
+            retry_params=retry_params, _account_id=_account_id) as gcs_file:
+    if isinstance(fileobj_or_path, basestring):
+      with __builtin__.open(fileobj_or_path, 'wb') as fileobj:
+        return gcs_file.download_to(fileobj, concurrency)
+    return gcs_file.download_to(fileobj_or_path, concurrency)
+
+
 def delete(filename, retry_params=None, _account_id=None):
   """Delete a Google Cloud Storage file.
 
@@ -117,11 +202,25 @@ def delete(filename, retry_params=None, _account_id=None):
   Raises:
     errors.NotFoundError: if the file doesn't exist prior to deletion.
   """
+  delete_async(filename, retry_params=retry_params,
+               _account_id=_account_id).get_result()
+
+
+@ndb.tasklet
+def delete_async(filename, retry_params=None, _account_id=None):
+  """Async version of delete().
+
+  Args:
+    See delete().
+
+  Returns:
+    A ndb Future. Errors that delete() would raise are raised by get_result().
+  """
   api = storage_api._get_storage_api(retry_params=retry_params,
                                      account_id=_account_id)
   common.validate_file_path(filename)
   filename = api_utils._quote_filename(filename)
-  status, resp_headers, content = api.delete_object(filename)
+  status, resp_headers, content = yield api.delete_object_async(filename)
   errors.check_status(status, [204], filename, resp_headers=resp_headers,
                       body=content)
 
@@ -142,22 +241,29 @@ def stat(filename, retry_params=None, _account_id=None):
     errors.AuthorizationError: if authorization failed.
     errors.NotFoundError: if an object that's expected to exist doesn't.
   """
+  return stat_async(filename, retry_params=retry_params,
+                    _account_id=_account_id).get_result()
+
+
+@ndb.tasklet
+def stat_async(filename, retry_params=None, _account_id=None):
+  """Async version of stat().
+
+  Args:
+    See stat().
+
+  Returns:
+    A ndb Future. Its result is a GCSFileStat. Errors that stat() would raise
+    are raised by get_result().
+  """
   common.validate_file_path(filename)
   api = storage_api._get_storage_api(retry_params=retry_params,
                                      account_id=_account_id)
-  status, headers, content = api.head_object(
+  status, headers, content = yield api.head_object_async(
       api_utils._quote_filename(filename))
   errors.check_status(status, [200], filename, resp_headers=headers,
                       body=content)
-  file_stat = common.GCSFileStat(
-      filename=filename,
-      st_size=common.get_stored_content_length(headers),
-      st_ctime=common.http_time_to_posix(headers.get('last-modified')),
-      etag=headers.get('etag'),
-      content_type=headers.get('content-type'),
-      metadata=common.get_metadata(headers))
-
-  return file_stat
+  raise ndb.Return(common.get_file_stat(filename, headers))
 
 
 def copy2(src, dst, metadata=None, retry_params=None):
@@ -323,10 +429,92 @@ def compose(list_of_files, destination_file, files_metadata=None,
   compose_object(file_list, destination_file, content_type)
 
 
+def write_object(filename, data, content_type=None, options=None,
+                 retry_params=None, _account_id=None):
+  """Writes a whole Google Cloud Storage file with a single request.
+
+  Cheaper than open() in writing mode for data already in memory, which
+  costs a request to start the upload and one to finish it once more than
+  1MB is written. data must fit in one urlfetch request.
+
+  Args:
+    filename: A Google Cloud Storage filename of form '/bucket/filename'.
+    data: the content of the file. str or any object supporting the buffer
+      protocol.
+    content_type: The MIME type of the file. str.
+    options: A str->basestring dict to specify additional headers to pass to
+      GCS e.g. {'x-goog-acl': 'private', 'x-goog-meta-foo': 'foo'}.
+      Supports the same options as open().
+    retry_params: An instance of api_utils.RetryParams for this call to GCS.
+      If None, the default one is used.
+    _account_id: Internal-use only.
+
+  Raises:
+    errors.AuthorizationError: if authorization failed.
+    errors.NotFoundError: if the bucket doesn't exist.
+    TypeError: if data is unicode or doesn't support the buffer protocol.
+  """
+  common.validate_file_path(filename)
+  common.validate_options(options)
+  api = storage_api._get_storage_api(retry_params=retry_params,
+                                     account_id=_account_id)
+  if not isinstance(data, str):
+    data = storage_api._byte_view(data).tobytes()
+  headers = {}
+  if options:
+    headers.update(options)
+  if content_type:
+    headers['content-type'] = content_type
+  storage_api._set_local_content_range(headers, len(data))
+  status, resp_headers, content = api.put_object(
+      api_utils._quote_filename(filename), payload=data, headers=headers)
+  errors.check_status(status, [200], filename, headers, resp_headers,
+                      body=content)
+
+
+def resume_upload(checkpoint_id, use_datastore=True, retry_params=None,
+                  _account_id=None):
+  """Reopens an upload saved with the checkpoint() method of a writing buffer.
+
+  Lets a later request or task finish an upload instead of starting it over,
+  e.g. after a DeadlineExceededError:
+
+    with cloudstorage.open(filename, 'w') as gcs_file:
+      ...
+      gcs_file.checkpoint(upload_id)
+
+  and later:
+
+    with cloudstorage.resume_upload(upload_id) as gcs_file:
+      source.seek(gcs_file.tell())
+      gcs_file.copy_from(source)
+
+  Args:
+    checkpoint_id: the id passed to checkpoint().
+    use_datastore: False if checkpoint() was called with it False.
+    retry_params: An instance of api_utils.RetryParams for subsequent calls
+      to GCS from this file handle. If None, the default one is used.
+    _account_id: Internal-use only.
+
+  Returns:
+    A writing buffer whose tell() is the number of bytes GCS has committed.
+    Writing continues from there; closing it finalizes the file and deletes
+    the checkpoint.
+
+  Raises:
+    errors.NotFoundError: if there is no such checkpoint.
+    errors.Error: if GCS no longer knows the upload.
+  """
+  api = storage_api._get_storage_api(retry_params=retry_params,
+                                     account_id=_account_id)
+  return storage_api.StreamingBuffer.resume(api, checkpoint_id,
+                                            use_datastore=use_datastore)
+
+
 def _file_exists(destination):
   """Checks if a file exists.
 
-  Tries to open the file.
+  Tries to stat the file, which is a single HEAD request.
   If it succeeds returns True otherwise False.
 
   Args:
@@ -336,8 +524,8 @@ def _file_exists(destination):
     True if the file is accessible otherwise False.
   """
   try:
-    with open(destination, "r"):
-      return True
+    stat(destination)
+    return True
   except errors.NotFoundError:
     return False
 
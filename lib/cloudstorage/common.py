@@ -27,6 +27,7 @@ __all__ = ['CS_XML_NS',
            'get_access_token',
            'get_stored_content_length',
            'get_metadata',
+           'get_file_stat',
            'GCSFileStat',
            'http_time_to_posix',
            'memory_usage',
@@ -192,12 +193,51 @@ def get_stored_content_length(headers):
   return length
 
 
+def get_content_range_size(headers):
+  """Return the total size of the object from a Content-Range header.
+
+  Args:
+    headers: a dict of headers from a 206 response, e.g. with
+      'content-range': 'bytes 0-1023/4096'.
+
+  Returns:
+    the total size as a str. None if the header is missing or the size is
+    unknown ('*').
+  """
+  content_range = headers.get('content-range')
+  if not content_range or '/' not in content_range:
+    return None
+  size = content_range.rsplit('/', 1)[1].strip()
+  if not size.isdigit():
+    return None
+  return size
+
+
 def get_metadata(headers):
   """Get user defined options from HTTP response headers."""
   return dict((k, v) for k, v in headers.iteritems()
               if any(k.lower().startswith(valid) for valid in _GCS_METADATA))
 
 
+def get_file_stat(filename, headers):
+  """Build a GCSFileStat from the HTTP response headers of an object.
+
+  Args:
+    filename: a Google Cloud Storage filename of form '/bucket/filename'.
+    headers: a dict of headers from a HEAD or GET response for the object.
+
+  Returns:
+    a GCSFileStat object containing info about this file.
+  """
+  return GCSFileStat(
+      filename=filename,
+      st_size=get_stored_content_length(headers),
+      st_ctime=http_time_to_posix(headers.get('last-modified')),
+      etag=headers.get('etag'),
+      content_type=headers.get('content-type'),
+      metadata=get_metadata(headers))
+
+
 def validate_bucket_name(name):
   """Validate a Google Storage bucket name.
 
@@ -18,13 +18,25 @@
 
 
 
-__all__ = ['ReadBuffer',
+__all__ = ['BlockCache',
+           'DiskBlockCache',
+           'GzipReadBuffer',
+           'ParallelStreamingBuffer',
+           'ReadBuffer',
            'StreamingBuffer',
+           'set_block_cache',
           ]
 
 import collections
+import hashlib
+import httplib
+import logging
+import mmap
 import os
+import threading
 import urlparse
+from xml.sax import saxutils
+import zlib
 
 from . import api_utils
 from . import common
@@ -169,7 +181,8 @@ class _StorageApi(rest_api._RestApi):
     """GET a bucket."""
     return self.do_request_async(self.api_url + path, 'GET', **kwds)
 
-  def compose_object(self, file_list, destination_file, content_type):
+  def compose_object(self, file_list, destination_file, content_type,
+                     gcs_headers=None):
     """COMPOSE multiple objects together.
 
     Using the given list of files, calls the put object with the compose flag.
@@ -179,6 +192,8 @@ class _StorageApi(rest_api._RestApi):
       file_list: list of dicts with the file name.
       destination_file: Path to the destination file.
       content_type: Content type for the destination file.
+      gcs_headers: additional gs headers for the destination file as a
+        str->str dict, e.g. {'x-goog-acl': 'private'}.
     """
 
     xml_setting_list = ['<ComposeRequest>']
@@ -191,10 +206,11 @@ class _StorageApi(rest_api._RestApi):
     xml_setting_list.append('</ComposeRequest>')
     xml = ''.join(xml_setting_list)
 
+    headers = {}
+    if gcs_headers:
+      headers.update(gcs_headers)
     if content_type is not None:
-      headers = {'Content-Type': content_type}
-    else:
-      headers = None
+      headers['Content-Type'] = content_type
     status, resp_headers, content = self.put_object(
         api_utils._quote_filename(destination_file) + '?compose',
         payload=xml,
@@ -206,29 +222,330 @@ class _StorageApi(rest_api._RestApi):
 _StorageApi = rest_api.add_sync_methods(_StorageApi)
 
 
+class BlockCache(object):
+  """A thread safe LRU cache of file blocks, shared by ReadBuffers.
+
+  Blocks are block_size aligned pieces of a file, keyed by
+  (path, etag, block index). A changed file gets a new etag, so its old
+  blocks are never served and just age out.
+
+  With a spill cache, e.g. a DiskBlockCache, blocks evicted from memory are
+  moved there and looked up there on a memory miss.
+
+  Only files of at most max_file_size bytes are read through memory, so one
+  large download does not evict every other file's blocks. Larger files are
+  read straight through the spill cache, if it takes files that large.
+
+  Attributes:
+    hits: number of blocks found in the cache.
+    misses: number of blocks that had to be fetched.
+  """
+
+  DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+  DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+  def __init__(self, max_bytes=DEFAULT_MAX_BYTES,
+               block_size=DEFAULT_BLOCK_SIZE,
+               spill=None,
+               max_file_size=None):
+    """Constructor.
+
+    Args:
+      max_bytes: max total size of the cached blocks.
+      block_size: size of a block. Must not be larger than the
+        max_request_size of the ReadBuffers using this cache.
+      spill: optional cache with the same interface that takes the blocks
+        evicted from this one.
+      max_file_size: size of the largest file to cache in memory. If None,
+        a quarter of max_bytes.
+    """
+    self.max_bytes = max_bytes
+    self.block_size = block_size
+    if max_file_size is None:
+      max_file_size = max_bytes // 4
+    self.max_file_size = max_file_size
+    self.hits = 0
+    self.misses = 0
+    self._size = 0
+    self._blocks = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._spill = spill
+
+  @property
+  def size(self):
+    """Total size of the cached blocks."""
+    return self._size
+
+  def cache_for(self, file_size):
+    """Returns the cache for the blocks of a file of this size, or None.
+
+    That is this cache for files up to max_file_size, else the spill cache
+    if it takes the file.
+    """
+    if file_size <= self.max_file_size:
+      return self
+    if self._spill is not None:
+      return self._spill.cache_for(file_size)
+    return None
+
+  def get(self, key):
+    """Returns the block for key, or None if it is not cached.
+
+    The block is a str, or whatever the spill cache returns for it.
+    """
+    with self._lock:
+      data = self._blocks.pop(key, None)
+      if data is not None:
+        self._blocks[key] = data
+        self.hits += 1
+        return data
+    if self._spill is not None:
+      data = self._spill.get(key)
+    with self._lock:
+      if data is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+    return data
+
+  def put(self, key, data):
+    """Cache a block, evicting the least recently used ones to make room."""
+    if len(data) > self.max_bytes:
+      if self._spill is not None:
+        self._spill.put(key, data)
+      return
+    evicted = []
+    with self._lock:
+      old = self._blocks.pop(key, None)
+      if old is not None:
+        self._size -= len(old)
+      self._blocks[key] = data
+      self._size += len(data)
+      while self._size > self.max_bytes:
+        evicted.append(self._blocks.popitem(last=False))
+        self._size -= len(evicted[-1][1])
+    if self._spill is not None:
+      for old_key, old in evicted:
+        self._spill.put(old_key, old)
+
+  def clear(self):
+    """Drop all blocks and reset the counters."""
+    with self._lock:
+      self._blocks.clear()
+      self._size = 0
+      self.hits = 0
+      self.misses = 0
+
+
+class DiskBlockCache(object):
+  """A thread safe LRU cache of file blocks in a local directory.
+
+  Has the same interface as BlockCache and is meant as its spill cache.
+  Every block is a file named after the hash of its (path, etag, block
+  index) key, so blocks of a changed file are never served. Blocks found
+  in the directory at startup are kept, oldest first in line for eviction.
+  Cached blocks are returned as read only mmaps, so only the parts a read
+  needs are copied out of the page cache.
+
+  This needs a writable local disk, which the App Engine standard
+  environment doesn't have.
+
+  Attributes:
+    hits: number of blocks found in the cache.
+    misses: number of blocks not found.
+  """
+
+  DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+  def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES,
+               block_size=BlockCache.DEFAULT_BLOCK_SIZE,
+               max_file_size=None):
+    """Constructor.
+
+    Args:
+      directory: the directory to keep blocks in. Created if missing.
+      max_bytes: max total size of the block files.
+      block_size: size of a block. Must be the same as the block_size of a
+        BlockCache spilling here.
+      max_file_size: size of the largest file to cache. If None, a quarter
+        of max_bytes. Blocks a BlockCache evicts here are taken whatever
+        the size of their file.
+    """
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.block_size = block_size
+    if max_file_size is None:
+      max_file_size = max_bytes // 4
+    self.max_file_size = max_file_size
+    self.hits = 0
+    self.misses = 0
+    self._size = 0
+    self._files = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    found = []
+    for name in os.listdir(directory):
+      path = os.path.join(directory, name)
+      if name.endswith('.tmp'):
+        self._remove(path)
+        continue
+      st = os.stat(path)
+      found.append((st.st_mtime, name, st.st_size))
+    for _, name, size in sorted(found):
+      self._files[name] = size
+      self._size += size
+    self._evict()
+
+  def cache_for(self, file_size):
+    """Returns this cache if it takes files of this size, else None."""
+    if file_size <= self.max_file_size:
+      return self
+    return None
+
+  @property
+  def size(self):
+    """Total size of the block files."""
+    return self._size
+
+  def get(self, key):
+    """Returns the block for key as a read only mmap, or None."""
+    name = self._file_name(key)
+    with self._lock:
+      size = self._files.pop(name, None)
+      if size is None:
+        self.misses += 1
+        return None
+      self._files[name] = size
+    try:
+      with open(os.path.join(self.directory, name), 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError, mmap.error):
+      with self._lock:
+        if self._files.pop(name, None) is not None:
+          self._size -= size
+        self.misses += 1
+      return None
+    with self._lock:
+      self.hits += 1
+    return data
+
+  def put(self, key, data):
+    """Write a block, evicting the least recently used ones to make room."""
+    if not data or len(data) > self.max_bytes:
+      return
+    name = self._file_name(key)
+    path = os.path.join(self.directory, name)
+    tmp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+    try:
+      with open(tmp_path, 'wb') as f:
+        f.write(data)
+      os.rename(tmp_path, path)
+    except (IOError, OSError):
+      self._remove(tmp_path)
+      return
+    with self._lock:
+      old = self._files.pop(name, None)
+      if old is not None:
+        self._size -= old
+      self._files[name] = len(data)
+      self._size += len(data)
+      self._evict()
+
+  def clear(self):
+    """Delete all block files and reset the counters."""
+    with self._lock:
+      for name in self._files:
+        self._remove(os.path.join(self.directory, name))
+      self._files.clear()
+      self._size = 0
+      self.hits = 0
+      self.misses = 0
+
+  def _evict(self):
+    while self._size > self.max_bytes:
+      name, size = self._files.popitem(last=False)
+      self._size -= size
+      self._remove(os.path.join(self.directory, name))
+
+  @staticmethod
+  def _remove(path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+  @staticmethod
+  def _file_name(key):
+    path, etag, index = key
+    return hashlib.sha1('%s\n%s\n%d' % (path, etag, index)).hexdigest()
+
+
+_block_cache = None
+
+
+def set_block_cache(cache):
+  """Set the BlockCache every ReadBuffer opened from now on reads through.
+
+  Args:
+    cache: a BlockCache, shared by all threads of this process. None turns
+      caching off.
+  """
+  global _block_cache
+  _block_cache = cache
+
+
 class ReadBuffer(object):
   """A class for reading Google storage files."""
 
   DEFAULT_BUFFER_SIZE = 1024 * 1024
   MAX_REQUEST_SIZE = 30 * DEFAULT_BUFFER_SIZE
+  DEFAULT_MAX_READAHEAD = 4 * DEFAULT_BUFFER_SIZE
+  DEFAULT_DOWNLOAD_CONCURRENCY = 8
+
+  _max_cached_segments = 4
 
   def __init__(self,
                api,
                path,
                buffer_size=DEFAULT_BUFFER_SIZE,
                max_request_size=MAX_REQUEST_SIZE,
-               offset=0):
+               offset=0,
+               max_readahead=DEFAULT_MAX_READAHEAD,
+               lazy=False):
     """Constructor.
 
     Args:
       api: A StorageApi instance.
       path: Quoted/escaped path to the object, e.g. /mybucket/myfile
       buffer_size: buffer size. The ReadBuffer keeps
-        one buffer. But there may be a pending future that contains
-        a second buffer. This size must be less than max_request_size.
+        one buffer. But there may be pending futures that contain
+        the next buffers. This size must be less than max_request_size.
       max_request_size: Max bytes to request in one urlfetch.
       offset: Number of bytes to skip at the start of the file. If None, 0 is
         used.
+      max_readahead: Max bytes of pending futures for the next buffers. The
+        readahead window starts at one buffer and doubles every time a
+        prefetched buffer is used, until it reaches this size. A seek
+        collapses it back to one buffer. At least one buffer is always
+        prefetched.
+      lazy: If True, no request is made until the file is first read, its
+        stat is asked for or a seek relative to its end is made. A missing
+        file is only reported then.
+
+    When a seek leaves the buffer or skips prefetched ones, they are kept,
+    up to _max_cached_segments of them, so seeking back into them does not
+    fetch them again. Sequential reads keep none.
+
+    The size, etag and stat of the file are taken from the response to the
+    first GET, so a file that fits in one buffer is opened and read with a
+    single request. A HEAD request is made only when that response can not
+    tell, e.g. for an empty file.
+
+    If a BlockCache is set with set_block_cache, data of files it takes is
+    read through it. The etag and size are needed for that, so the HEAD
+    request is then always made first.
     """
     self._api = api
     self._path = path
@@ -239,25 +556,99 @@ class ReadBuffer(object):
     self._buffer_size = buffer_size
     self._max_request_size = max_request_size
     self._offset = offset
+    self._max_readahead = max_readahead
 
     self._buffer = _Buffer()
+    self._buffer_start = offset
+    self._readahead = collections.deque()
+    self._readahead_window = 1
+    self._segments = collections.OrderedDict()
+    self._block_cache = _block_cache
     self._etag = None
+    self._file_size = None
+    self._stat = None
+    self._content_encoding = None
 
-    get_future = self._get_segment(offset, self._buffer_size, check_response=False)
+    if not lazy:
+      self._open()
 
-    status, headers, content = self._api.head_object(path)
-    errors.check_status(status, [200], path, resp_headers=headers, body=content)
-    self._file_size = long(common.get_stored_content_length(headers))
-    self._check_etag(headers.get('etag'))
+  def _open(self):
+    """Make the requests that open the file, unless they were made already.
+
+    Fills the buffer from the current offset, which is moved to EOF if it is
+    past it, and starts prefetching.
+
+    Raises:
+      errors.NotFoundError: if the file doesn't exist.
+    """
+    if self._file_size is not None:
+      return
+    self._buffer_start = self._offset
+
+    if self._block_cache is None and self._get_first_segment():
+      self._offset = min(self._offset, self._file_size)
+      self._buffer_start = self._offset
+      self._request_next_buffer()
+      return
 
-    self._buffer_future = None
+    status, headers, content = self._api.head_object(self._path)
+    errors.check_status(status, [200], self._path, resp_headers=headers,
+                        body=content)
+    file_size = long(common.get_stored_content_length(headers))
+    self._check_etag(headers.get('etag'))
+    self._stat = common.get_file_stat(self.name, headers)
+    self._content_encoding = headers.get('content-encoding')
+    if self._block_cache is not None:
+      self._block_cache = self._block_cache.cache_for(file_size)
+    self._offset = min(self._offset, file_size)
+    self._buffer_start = self._offset
+    self._file_size = file_size
 
-    if self._file_size != 0:
-      content, check_response_closure = get_future.get_result()
-      check_response_closure()
-      self._buffer.reset(content)
+    if self._remaining():
+      self._buffer.reset(self._get_segment(self._offset, self._buffer_size)
+                         .get_result())
       self._request_next_buffer()
 
+  def _get_first_segment(self):
+    """Fill the buffer and learn about the file from one ranged GET.
+
+    Returns:
+      True if the file size, etag and stat were set from the response.
+      False if a HEAD request is needed, because the range was not
+      satisfiable (the file is empty or offset is past its end) or the
+      response lacks the total size.
+
+    Raises:
+      errors.NotFoundError: if the file doesn't exist.
+    """
+    headers = {'Range': 'bytes=%d-%d' % (self._offset,
+                                         self._offset + self._buffer_size - 1)}
+    status, resp_headers, content = self._api.get_object(
+        self._path, headers=headers)
+    if status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+      return False
+    errors.check_status(status, [200, 206], self._path, headers,
+                        resp_headers, body=content)
+
+    size = resp_headers.get('x-goog-stored-content-length')
+    if size is None and status == httplib.PARTIAL_CONTENT:
+      size = common.get_content_range_size(resp_headers)
+    elif size is None:
+      size = resp_headers.get('content-length')
+    if size is None:
+      return False
+
+    resp_headers = dict(resp_headers)
+    resp_headers['x-goog-stored-content-length'] = size
+    self._file_size = long(size)
+    self._check_etag(resp_headers.get('etag'))
+    self._stat = common.get_file_stat(self.name, resp_headers)
+    self._content_encoding = resp_headers.get('content-encoding')
+    if status == httplib.OK:
+      content = content[self._offset:self._offset + self._buffer_size]
+    self._buffer.reset(content)
+    return True
+
   def __getstate__(self):
     """Store state as part of serialization/pickling.
 
@@ -275,7 +666,10 @@ class ReadBuffer(object):
             'request_size': self._max_request_size,
             'etag': self._etag,
             'size': self._file_size,
+            'stat': self._stat,
+            'content_encoding': self._content_encoding,
             'offset': self._offset,
+            'max_readahead': self._max_readahead,
             'closed': self.closed}
 
   def __setstate__(self, state):
@@ -293,13 +687,38 @@ class ReadBuffer(object):
     self._max_request_size = state['request_size']
     self._etag = state['etag']
     self._file_size = state['size']
+    self._stat = state.get('stat')
+    self._content_encoding = state.get('content_encoding')
     self._offset = state['offset']
+    self._max_readahead = state.get('max_readahead',
+                                    self.DEFAULT_MAX_READAHEAD)
     self._buffer = _Buffer()
+    self._buffer_start = self._offset
+    self._readahead = collections.deque()
+    self._readahead_window = 1
+    self._segments = collections.OrderedDict()
+    self._block_cache = _block_cache
+    if self._block_cache is not None and self._file_size is not None:
+      self._block_cache = self._block_cache.cache_for(self._file_size)
     self.closed = state['closed']
-    self._buffer_future = None
-    if self._remaining() and not self.closed:
+    if (self._file_size is not None and self._remaining() and
+        not self.closed):
       self._request_next_buffer()
 
+  @property
+  def stat(self):
+    """GCSFileStat of this file, taken from the first response open gets."""
+    if not self.closed:
+      self._open()
+    return self._stat
+
+  @property
+  def content_encoding(self):
+    """Content-Encoding the file is stored with, e.g. 'gzip', or None."""
+    if not self.closed:
+      self._open()
+    return self._content_encoding
+
   def __iter__(self):
     """Iterator interface.
 
@@ -309,6 +728,9 @@ class ReadBuffer(object):
     cannot easily be created that iterates independently over the same values.
     You could open the file for the second time, or seek() to the beginning.'
 
+    Iteration calls readline() for each line. To scan a large file use
+    iter_lines() instead.
+
     Returns:
       Self.
     """
@@ -340,6 +762,7 @@ class ReadBuffer(object):
       IOError: When this buffer is closed.
     """
     self._check_open()
+    self._open()
     if size == 0 or not self._remaining():
       return ''
 
@@ -349,10 +772,11 @@ class ReadBuffer(object):
       data = self._buffer.read(size)
       size -= len(data)
       self._offset += len(data)
-      data_list.append(data)
+      if data:
+        data_list.append(data)
       if size == 0 or not self._remaining():
         return ''.join(data_list)
-      self._buffer.reset(self._buffer_future.get_result())
+      self._next_buffer()
       self._request_next_buffer()
       newline_offset = self._buffer.find_newline(size)
 
@@ -362,6 +786,74 @@ class ReadBuffer(object):
 
     return ''.join(data_list)
 
+  def readlines(self, hint=-1):
+    """Read lines from the file, splitting a whole buffer at a time.
+
+    Every buffer is split into lines in one go; only a line that crosses a
+    buffer boundary is joined. Lines are the same as readline() returns.
+
+    Args:
+      hint: Stop once about this many bytes have been read. Reading still
+        finishes the current buffer, so more may be returned. If 0, negative
+        or unspecified, read to EOF.
+
+    Returns:
+      A list of lines as strings. Empty only at EOF.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    self._open()
+    lines = []
+    read = 0
+    partial = []
+    while self._remaining():
+      if not self._buffer.remaining():
+        self._next_buffer()
+        self._request_next_buffer()
+      newline_offset = self._buffer.rfind_newline()
+      if newline_offset < 0:
+        data = self._buffer.read()
+        self._offset += len(data)
+        partial.append(data)
+        continue
+
+      data = self._buffer.read_to_offset(newline_offset + 1)
+      self._offset += len(data)
+      read += len(data)
+      if partial:
+        partial.append(data)
+        data = ''.join(partial)
+        partial = []
+      lines.extend(_split_lines(data))
+      if hint > 0 and read >= hint:
+        break
+
+    if partial:
+      lines.append(''.join(partial))
+    return lines
+
+  def iter_lines(self):
+    """Iterate over the rest of the file line by line.
+
+    Much cheaper per line than iterating over the file itself, because lines
+    are fetched with readlines() a buffer at a time. tell() moves ahead by a
+    buffer at a time too, so do not mix this with other reads.
+
+    Yields:
+      Lines as strings, as readline() returns them.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    while True:
+      lines = self.readlines(self._buffer_size)
+      if not lines:
+        return
+      for line in lines:
+        yield line
+
   def read(self, size=-1):
     """Read data from RAW file.
 
@@ -377,6 +869,7 @@ class ReadBuffer(object):
       IOError: When this buffer is closed.
     """
     self._check_open()
+    self._open()
     if not self._remaining():
       return ''
 
@@ -390,38 +883,231 @@ class ReadBuffer(object):
       else:
         size -= remaining
         self._offset += remaining
-        data_list.append(self._buffer.read())
+        if remaining:
+          data_list.append(self._buffer.read())
 
-        if self._buffer_future is None:
+        if not self._readahead:
           if size < 0 or size >= self._remaining():
             needs = self._remaining()
           else:
             needs = size
           data_list.extend(self._get_segments(self._offset, needs))
           self._offset += needs
+          self._replace_buffer(self._offset)
           break
 
-        if self._buffer_future:
-          self._buffer.reset(self._buffer_future.get_result())
-          self._buffer_future = None
+        self._next_buffer()
 
-    if self._buffer_future is None:
-      self._request_next_buffer()
+    self._request_next_buffer()
+    if len(data_list) == 1:
+      return data_list[0]
     return ''.join(data_list)
 
+  def readinto(self, b):
+    """Read up to len(b) bytes into b.
+
+    Unlike read(), no strings are built for the caller: every byte is copied
+    once, from the fetched segment straight into b. Use this to read large
+    files into a reused bytearray.
+
+    Args:
+      b: a writable object supporting the buffer protocol, e.g. a bytearray.
+
+    Returns:
+      Number of bytes read as an int. Less than len(b) only at EOF; 0 when
+      EOF is encountered immediately.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    self._open()
+    view = memoryview(b)
+    size = len(view)
+    read = 0
+    while read < size and self._remaining():
+      if not self._buffer.remaining():
+        if not self._readahead:
+          needs = min(size - read, self._remaining())
+          for segment in self._get_segments(self._offset, needs):
+            view[read:read + len(segment)] = segment
+            read += len(segment)
+          self._offset += needs
+          self._replace_buffer(self._offset)
+          break
+        self._next_buffer()
+      copied = self._buffer.readinto(view[read:])
+      read += copied
+      self._offset += copied
+
+    self._request_next_buffer()
+    return read
+
+  def read_ranges(self, ranges):
+    """Read byte ranges of the file, leaving the buffer and offset alone.
+
+    Each range is fetched with requests sized to it, all of them at once,
+    and nothing past it is prefetched. On a lazy handle no other request is
+    made, so this is the cheapest way to read a few ranges of a file whose
+    size is known.
+
+    Args:
+      ranges: a list of (start, end) tuples of inclusive offsets within the
+        file.
+
+    Returns:
+      A list of the content of each range as str, in the order of ranges.
+
+    Raises:
+      IOError: When this buffer is closed.
+      ValueError: if the file has changed while reading.
+    """
+    self._check_open()
+    futures = []
+    for start, end in ranges:
+      range_futures = []
+      while start <= end:
+        request_size = min(end - start + 1, self._max_request_size)
+        range_futures.append(self._get_segment(start, request_size))
+        start += request_size
+      futures.append(range_futures)
+    return [''.join(f.get_result() for f in range_futures)
+            for range_futures in futures]
+
+  def download_to(self, fileobj, concurrency=DEFAULT_DOWNLOAD_CONCURRENCY):
+    """Write the rest of the file to fileobj using parallel range requests.
+
+    Up to concurrency buffer sized segments are requested at once. If fileobj
+    supports tell() and seek(), every segment is written at its own offset as
+    soon as it arrives. Otherwise segments are written in order, holding the
+    ones that arrive early. Either way memory is bounded by concurrency
+    segments, not by the size of the file.
+
+    Args:
+      fileobj: a file-like object open for writing, e.g. a local file or a
+        stream.
+      concurrency: max number of segments requested at once.
+
+    Returns:
+      The number of bytes written.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    self._open()
+    start_offset = self._offset
+    try:
+      base = fileobj.tell() - self._offset
+    except (AttributeError, IOError):
+      base = None
+
+    data = self._buffer.read()
+    fileobj.write(data)
+    self._offset += len(data)
+    self._segments.clear()
+
+    # reuse the requests already made for the prefetched buffers
+    pending = dict((future, offset) for offset, future in self._readahead)
+    self._readahead.clear()
+    if pending:
+      next_offset = max(pending.itervalues()) + self._buffer_size
+    else:
+      next_offset = self._offset
+    arrived = {}
+
+    while pending or next_offset < self._file_size:
+      while (len(pending) + len(arrived) < concurrency and
+             next_offset < self._file_size):
+        request_size = min(self._buffer_size, self._file_size - next_offset)
+        pending[self._get_segment(next_offset, request_size)] = next_offset
+        next_offset += request_size
+
+      future = ndb.Future.wait_any(pending)
+      offset = pending.pop(future)
+      data = future.get_result()
+      if base is None:
+        arrived[offset] = data
+        while self._offset in arrived:
+          data = arrived.pop(self._offset)
+          fileobj.write(data)
+          self._offset += len(data)
+      else:
+        fileobj.seek(base + offset)
+        fileobj.write(data)
+
+    if base is not None:
+      self._offset = self._file_size
+      fileobj.seek(base + self._offset)
+    self._replace_buffer(self._offset)
+    return self._offset - start_offset
+
   def _remaining(self):
     return self._file_size - self._offset
 
+  def _next_buffer(self):
+    """Replace the buffer with the first prefetched one.
+
+    The buffer must be used up. Since reading is sequential so far, the
+    readahead window is widened.
+    """
+    start, future = self._readahead.popleft()
+    self._replace_buffer(start, future.get_result())
+    self._readahead_window = min(
+        self._readahead_window * 2,
+        max(1, self._max_readahead // self._buffer_size))
+
   def _request_next_buffer(self):
-    """Request next buffer.
+    """Request next buffers until the readahead window is full.
+
+    Requires self._offset, self._buffer and self._readahead are in
+    consistent state.
+    """
+    if self._readahead:
+      next_offset = self._readahead[-1][0] + self._buffer_size
+    else:
+      next_offset = self._offset + self._buffer.remaining()
+    while (len(self._readahead) < self._readahead_window and
+           next_offset < self._file_size):
+      future = self._segments.pop(next_offset, None)
+      if future is None:
+        future = self._get_segment(next_offset, self._buffer_size)
+      self._readahead.append((next_offset, future))
+      next_offset += self._buffer_size
+
+  def _replace_buffer(self, start, content='', offset=0, keep_old=False):
+    """Make content the buffer.
+
+    Args:
+      start: offset of content in the file.
+      content: the new buffer, a segment of the file as str.
+      offset: offset to read from in content.
+      keep_old: whether to keep the old buffer as a cached segment. Only
+        seeks do, so sequential reads don't hold on to used up buffers.
+    """
+    old = self._buffer.getvalue()
+    if old and keep_old:
+      future = ndb.Future()
+      future.set_result(old)
+      self._cache_segment(self._buffer_start, future)
+    self._buffer_start = start
+    self._buffer.reset(content, offset)
 
-    Requires self._offset and self._buffer are in consistent state.
+  def _cache_segment(self, start, future):
+    """Keep a fetched or pending segment, dropping the least recently used.
+
+    Args:
+      start: offset of the segment in the file.
+      future: a future for the segment content.
     """
-    self._buffer_future = None
-    next_offset = self._offset + self._buffer.remaining()
-    if next_offset != self._file_size:
-      self._buffer_future = self._get_segment(next_offset,
-                                              self._buffer_size)
+    self._segments.pop(start, None)
+    self._segments[start] = future
+    while len(self._segments) > self._max_cached_segments:
+      self._segments.popitem(last=False)
+
+  def _segment_end(self, start):
+    """Returns the end offset, exclusive, of the segment fetched at start."""
+    return min(start + self._buffer_size, self._file_size)
 
   def _get_segments(self, start, request_size):
     """Get segments of the file from Google Storage as a list.
@@ -474,6 +1160,13 @@ class ReadBuffer(object):
     Raises:
       ValueError: if the file has changed while reading.
     """
+    if (self._block_cache is not None and self._etag is not None and
+        self._file_size is not None):
+      content = yield self._get_cached_segment(start, request_size)
+      if check_response:
+        raise ndb.Return(content)
+      raise ndb.Return(content, lambda: None)
+
     end = start + request_size - 1
     content_range = '%d-%d' % (start, end)
     headers = {'Range': 'bytes=' + content_range}
@@ -488,14 +1181,68 @@ class ReadBuffer(object):
       raise ndb.Return(content)
     raise ndb.Return(content, _checker)
 
+  @ndb.tasklet
+  def _get_cached_segment(self, start, request_size):
+    """Get a segment of the file from the blocks covering it.
+
+    Blocks missing from the cache are fetched concurrently and cached.
+
+    Args:
+      start: start offset of the segment. Inclusive.
+      request_size: number of bytes to request.
+
+    Yields:
+      The segment [start, start + request_size) of the file.
+    """
+    cache = self._block_cache
+    block_size = cache.block_size
+    first = start // block_size
+    last = (min(start + request_size, self._file_size) - 1) // block_size
+    blocks = []
+    fetches = {}
+    for index in xrange(first, last + 1):
+      key = (self._path, self._etag, index)
+      data = cache.get(key)
+      if data is None:
+        data = self._fetch_block(index * block_size, block_size)
+        fetches[index - first] = (key, data)
+      blocks.append(data)
+    for i, (key, future) in fetches.iteritems():
+      blocks[i] = yield future
+      cache.put(key, blocks[i])
+
+    # Slice only what is needed out of every block; blocks from a disk
+    # cache are mmaps and can't be joined directly.
+    offset = start - first * block_size
+    end = offset + request_size
+    parts = []
+    for i, block in enumerate(blocks):
+      parts.append(block[max(offset - i * block_size, 0):
+                         end - i * block_size])
+    if len(parts) == 1:
+      raise ndb.Return(parts[0])
+    raise ndb.Return(''.join(parts))
+
+  @ndb.tasklet
+  def _fetch_block(self, start, request_size):
+    """Fetch a block for the cache, bypassing it."""
+    end = start + request_size - 1
+    headers = {'Range': 'bytes=%d-%d' % (start, end)}
+    status, resp_headers, content = yield self._api.get_object_async(
+        self._path, headers=headers)
+    errors.check_status(status, [200, 206], self._path, headers,
+                        resp_headers, body=content)
+    self._check_etag(resp_headers.get('etag'))
+    raise ndb.Return(content)
+
   def _check_etag(self, etag):
     """Check if etag is the same across requests to GCS.
 
     If self._etag is None, set it. If etag is set, check that the new
     etag equals the old one.
 
-    In the __init__ method, we fire one HEAD and one GET request using
-    ndb tasklet. One of them would return first and set the first value.
+    The first value comes from the first response __init__ gets, either to
+    a GET or a HEAD request.
 
     Args:
       etag: etag from a GCS HTTP response. None if etag is not part of the
@@ -515,7 +1262,8 @@ class ReadBuffer(object):
   def close(self):
     self.closed = True
     self._buffer = None
-    self._buffer_future = None
+    self._readahead = None
+    self._segments = None
 
   def __enter__(self):
     return self
@@ -541,20 +1289,57 @@ class ReadBuffer(object):
     """
     self._check_open()
 
-    self._buffer.reset()
-    self._buffer_future = None
-
     if whence == os.SEEK_SET:
-      self._offset = offset
+      target = offset
     elif whence == os.SEEK_CUR:
-      self._offset += offset
+      target = self._offset + offset
     elif whence == os.SEEK_END:
-      self._offset = self._file_size + offset
+      self._open()
+      target = self._file_size + offset
     else:
       raise ValueError('Whence mode %s is invalid.' % str(whence))
 
-    self._offset = min(self._offset, self._file_size)
-    self._offset = max(self._offset, 0)
+    if self._file_size is None:
+      # Not opened yet, the first read starts here.
+      self._offset = max(target, 0)
+      return
+
+    target = min(target, self._file_size)
+    target = max(target, 0)
+
+    # Inside the buffer: only the offset into it moves.
+    buffer_offset = target - self._buffer_start
+    if 0 <= buffer_offset < len(self._buffer):
+      self._buffer.seek(buffer_offset)
+      self._offset = target
+      return
+
+    # Inside a prefetched buffer: skip to it and keep prefetching after it.
+    if self._readahead and self._readahead[0][0] <= target:
+      while self._readahead:
+        start, future = self._readahead.popleft()
+        if target < self._segment_end(start):
+          self._replace_buffer(start, future.get_result(), target - start,
+                               keep_old=True)
+          self._offset = target
+          self._request_next_buffer()
+          return
+        self._cache_segment(start, future)
+
+    # Elsewhere: reuse a cached segment if one holds target, else refetch.
+    for start, future in self._readahead:
+      self._cache_segment(start, future)
+    self._readahead.clear()
+    self._readahead_window = 1
+    self._offset = target
+    for start in self._segments:
+      if start <= target < self._segment_end(start):
+        future = self._segments.pop(start)
+        self._replace_buffer(start, future.get_result(), target - start,
+                             keep_old=True)
+        break
+    else:
+      self._replace_buffer(target, keep_old=True)
     if self._remaining():
       self._request_next_buffer()
 
@@ -585,15 +1370,34 @@ class ReadBuffer(object):
 
 
 class _Buffer(object):
-  """In memory buffer."""
+  """In memory buffer.
+
+  The content is also exposed as a memoryview so readinto() can copy it
+  straight into a caller's buffer without making intermediate strings.
+  """
 
   def __init__(self):
     self.reset()
 
   def reset(self, content='', offset=0):
     self._buffer = content
+    self._view = memoryview(content)
     self._offset = offset
 
+  def readinto(self, view):
+    """Copy bytes from self._buffer into view and update related offsets.
+
+    Args:
+      view: a writable memoryview. As many bytes as fit are copied.
+
+    Returns:
+      Number of bytes copied.
+    """
+    size = min(len(view), self.remaining())
+    view[:size] = self._view[self._offset:self._offset + size]
+    self._offset += size
+    return size
+
   def read(self, size=-1):
     """Returns bytes from self._buffer and update related offsets.
 
@@ -627,6 +1431,15 @@ class _Buffer(object):
   def remaining(self):
     return len(self._buffer) - self._offset
 
+  def __len__(self):
+    return len(self._buffer)
+
+  def getvalue(self):
+    return self._buffer
+
+  def seek(self, offset):
+    self._offset = offset
+
   def find_newline(self, size=-1):
     """Search for newline char in buffer starting from current offset.
 
@@ -640,125 +1453,611 @@ class _Buffer(object):
       return self._buffer.find('\n', self._offset)
     return self._buffer.find('\n', self._offset, self._offset + size)
 
+  def rfind_newline(self):
+    """Search for the last newline char in the rest of the buffer.
 
-class StreamingBuffer(object):
-  """A class for creating large objects using the 'resumable' API.
+    Returns:
+      offset of the last newline char in buffer. -1 if doesn't exist.
+    """
+    return self._buffer.rfind('\n', self._offset)
 
-  The API is a subset of the Python writable stream API sufficient to
-  support writing zip files using the zipfile module.
 
-  The exact sequence of calls and use of headers is documented at
-  https://developers.google.com/storage/docs/developer-guide#unknownresumables
-  """
+def _set_local_content_range(headers, size):
+  """Make a single request upload acceptable to the dev appserver.
 
-  _blocksize = 256 * 1024
+  The gcs stub of the dev appserver rejects a PUT without a content-range,
+  so there the whole object is described as one complete range.
 
-  _flushsize = 8 * _blocksize
+  Args:
+    headers: the headers of the PUT, updated in place.
+    size: size of the object.
+  """
+  if not common.local_run():
+    return
+  if size:
+    headers['content-range'] = 'bytes 0-%d/%d' % (size - 1, size)
+  else:
+    headers['content-range'] = 'bytes */0'
 
-  _maxrequestsize = 9 * 4 * _blocksize
 
-  def __init__(self,
-               api,
-               path,
-               content_type=None,
-               gcs_headers=None):
-    """Constructor.
+def _byte_view(data):
+  """Returns a memoryview of the bytes of data.
 
-    Args:
-      api: A StorageApi instance.
-      path: Quoted/escaped path to the object, e.g. /mybucket/myfile
-      content_type: Optional content-type; Default value is
-        delegate to Google Cloud Storage.
-      gcs_headers: additional gs headers as a str->str dict, e.g
-        {'x-goog-acl': 'private', 'x-goog-meta-foo': 'foo'}.
-    Raises:
-      IOError: When this location can not be found.
-    """
-    assert self._maxrequestsize > self._blocksize
-    assert self._maxrequestsize % self._blocksize == 0
-    assert self._maxrequestsize >= self._flushsize
+  Args:
+    data: str or any object supporting the buffer protocol.
 
-    self._api = api
-    self._path = path
+  Raises:
+    TypeError: if data is unicode or doesn't support the buffer protocol.
+  """
+  if isinstance(data, unicode):
+    raise TypeError('Expected str but got %s.' % type(data))
+  try:
+    view = memoryview(data)
+  except TypeError:
+    # e.g. array.array, which only has the old buffer interface
+    try:
+      view = memoryview(buffer(data))
+    except TypeError:
+      raise TypeError('Expected str or a buffer but got %s.' % type(data))
+  if view.ndim > 1 or view.itemsize != 1:
+    view = memoryview(view.tobytes())
+  return view
 
-    self.name = api_utils._unquote_filename(path)
-    self.closed = False
 
-    self._buffer = collections.deque()
-    self._buffered = 0
-    self._written = 0
-    self._offset = 0
+def _split_lines(data):
+  """Split data into lines delimited by '\n', keeping the newlines.
 
-    headers = {'x-goog-resumable': 'start'}
-    if content_type:
-      headers['content-type'] = content_type
-    if gcs_headers:
-      headers.update(gcs_headers)
-    status, resp_headers, content = self._api.post_object(path, headers=headers)
-    errors.check_status(status, [201], path, headers, resp_headers,
-                        body=content)
-    loc = resp_headers.get('location')
-    if not loc:
-      raise IOError('No location header found in 201 response')
-    parsed = urlparse.urlparse(loc)
-    self._path_with_token = '%s?%s' % (self._path, parsed.query)
+  Args:
+    data: str ending with '\n'.
 
-  def __getstate__(self):
-    """Store state as part of serialization/pickling.
+  Returns:
+    A list of lines.
+  """
+  if '\r' not in data:
+    return data.splitlines(True)
+  return [line + '\n' for line in data.split('\n')[:-1]]
 
-    The contents of the write buffer are stored. Writes to the underlying
-    storage are required to be on block boundaries (_blocksize) except for the
-    last write. In the worst case the pickled version of this object may be
-    slightly larger than the blocksize.
 
-    Returns:
-      A dictionary with the state of this object
+class GzipReadBuffer(object):
+  """A class for reading gzip encoded files as their decoded content.
 
-    """
-    return {'api': self._api,
-            'path': self._path,
-            'path_token': self._path_with_token,
-            'buffer': self._buffer,
-            'buffered': self._buffered,
-            'written': self._written,
-            'offset': self._offset,
-            'closed': self.closed}
+  The stored bytes are read through a ReadBuffer a chunk at a time and
+  inflated incrementally, so memory stays bounded by about two chunks
+  whatever the size of the file. Concatenated gzip members are decoded one
+  after the other, like the gzip module does. A file not stored with
+  content-encoding gzip is read as is.
 
-  def __setstate__(self, state):
-    """Restore state as part of deserialization/unpickling.
+  Offsets count decoded bytes. Only reading forward is supported. A file
+  that ends in the middle of a gzip member raises IOError once its last
+  decoded bytes have been read, like the gzip module does.
+  """
+
+  def __init__(self, raw, chunk_size=None):
+    """Constructor.
+
+    Args:
+      raw: a ReadBuffer for the stored bytes of the file. Closed with this
+        buffer.
+      chunk_size: max number of bytes read from raw or inflated at once.
+        Defaults to the buffer size of raw.
+    """
+    self._raw = raw
+    self._chunk_size = chunk_size or raw._buffer_size
+    self.name = raw.name
+    self.closed = False
+
+    self._buffer = _Buffer()
+    self._offset = 0
+    self._input = ''
+    self._decompressor = None
+    self._member_started = False
+    self._checked_encoding = False
+
+  @property
+  def stat(self):
+    """GCSFileStat of this file. st_size is the stored, encoded size."""
+    return self._raw.stat
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    line = self.readline()
+    if not line:
+      raise StopIteration()
+    return line
+
+  def readline(self, size=-1):
+    """Read one line delimited by '\n' from the decoded file.
+
+    Args:
+      size: Maximum number of bytes to read. If not specified, readline stops
+        only on '\n' or EOF.
+
+    Returns:
+      The data read as a string.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    data_list = []
+    newline_offset = self._buffer.find_newline(size)
+    while newline_offset < 0:
+      data = self._buffer.read(size)
+      size -= len(data)
+      self._offset += len(data)
+      if data:
+        data_list.append(data)
+      if size == 0 or not self._fill():
+        return ''.join(data_list)
+      newline_offset = self._buffer.find_newline(size)
+
+    data = self._buffer.read_to_offset(newline_offset + 1)
+    self._offset += len(data)
+    data_list.append(data)
+    return ''.join(data_list)
+
+  def read(self, size=-1):
+    """Read decoded data.
+
+    Args:
+      size: Number of bytes to read as integer. Actual number of bytes
+        read is always equal to size unless EOF is reached. If size is
+        negative or unspecified, read the entire file.
+
+    Returns:
+      data read as str.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    data_list = []
+    while True:
+      data = self._buffer.read(size)
+      self._offset += len(data)
+      if data:
+        data_list.append(data)
+      if size >= 0:
+        size -= len(data)
+        if size == 0:
+          break
+      if not self._fill():
+        break
+    if len(data_list) == 1:
+      return data_list[0]
+    return ''.join(data_list)
+
+  def _fill(self):
+    """Replace the used up buffer with the next decoded chunk.
+
+    Returns:
+      False at EOF, True otherwise.
+
+    Raises:
+      IOError: if the file ends in the middle of a gzip member.
+    """
+    if not self._checked_encoding:
+      self._checked_encoding = True
+      if 'gzip' in (self._raw.content_encoding or ''):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    while True:
+      if not self._input:
+        self._input = self._raw.read(self._chunk_size)
+        if not self._input:
+          if self._decompressor is None:
+            return False
+          if self._member_started:
+            self._check_member_end()
+            self._member_started = False
+          data = self._decompressor.flush()
+          self._buffer.reset(data)
+          return bool(data)
+      if self._decompressor is None:
+        data, self._input = self._input, ''
+      else:
+        data = self._decompressor.decompress(self._input, self._chunk_size)
+        self._member_started = True
+        self._input = self._decompressor.unconsumed_tail
+        if self._decompressor.unused_data:
+          # the next gzip member starts, unless it's just trailing padding
+          self._input = self._decompressor.unused_data.lstrip('\0')
+          self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+          self._member_started = False
+      if data:
+        self._buffer.reset(data)
+        return True
+
+  def _check_member_end(self):
+    """Raise IOError unless the current gzip member is complete.
+
+    Input past the end of a member is left in unused_data, so a byte fed
+    to a copy of the decompressor ends up there only if the member ended.
+    """
+    probe = self._decompressor.copy()
+    try:
+      probe.decompress('\0')
+    except zlib.error:
+      pass
+    if not probe.unused_data:
+      raise IOError('Compressed file ended before the end-of-stream marker '
+                    'was reached')
+
+  def tell(self):
+    """Tell the offset in the decoded file.
+
+    Returns:
+      current offset in reading this file.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    return self._offset
+
+  def close(self):
+    self.closed = True
+    self._buffer = None
+    self._input = None
+    self._decompressor = None
+    self._raw.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, atype, value, traceback):
+    self.close()
+    return False
+
+  def _check_open(self):
+    if self.closed:
+      raise IOError('Buffer is closed.')
+
+  def seekable(self):
+    return False
+
+  def readable(self):
+    return True
+
+  def writable(self):
+    return False
+
+
+class _AE_UploadCheckpoint_(ndb.Model):
+  """Entity to store a resumable upload session for StreamingBuffer.resume."""
+
+  path = ndb.StringProperty(indexed=False)
+  path_token = ndb.TextProperty()
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class StreamingBuffer(object):
+  """A class for creating large objects using the 'resumable' API.
+
+  The API is a subset of the Python writable stream API sufficient to
+  support writing zip files using the zipfile module.
+
+  The exact sequence of calls and use of headers is documented at
+  https://developers.google.com/storage/docs/developer-guide#unknownresumables
+
+  Written data is copied once into a bytearray, and every request payload
+  is copied once out of it. Large writes go in _flushsize slices, so the
+  bytearray stays around _flushsize bytes.
+  """
+
+  _blocksize = 256 * 1024
+
+  _flushsize = 8 * _blocksize
+
+  _maxrequestsize = 9 * 4 * _blocksize
+
+  _single_request_size = 4 * _blocksize
+
+  def __init__(self,
+               api,
+               path,
+               content_type=None,
+               gcs_headers=None):
+    """Constructor.
+
+    Args:
+      api: A StorageApi instance.
+      path: Quoted/escaped path to the object, e.g. /mybucket/myfile
+      content_type: Optional content-type; Default value is
+        delegate to Google Cloud Storage.
+      gcs_headers: additional gs headers as a str->str dict, e.g
+        {'x-goog-acl': 'private', 'x-goog-meta-foo': 'foo'}.
+
+    No request is sent here. A file of at most _single_request_size bytes is
+    sent by close() with a single PUT. Once more than that is written, the
+    request starting the resumable upload is sent, and its response is only
+    waited for the first time data has to go to GCS. Errors from it, such as
+    IOError when this location can not be found, are raised at that point.
+    """
+    assert self._maxrequestsize > self._blocksize
+    assert self._maxrequestsize % self._blocksize == 0
+    assert self._maxrequestsize >= self._flushsize
+
+    self._api = api
+    self._path = path
+
+    self.name = api_utils._unquote_filename(path)
+    self.closed = False
+
+    self._buffer = bytearray()
+    self._buffered = 0
+    self._written = 0
+    self._offset = 0
+
+    self._content_type = content_type
+    self._gcs_headers = gcs_headers
+    self._path_with_token = None
+    self._start_future = None
+    self._pending_put = None
+    self._checkpoint = None
+
+  def _start_upload(self):
+    """Send the request starting the resumable upload, unless it was sent."""
+    if self._path_with_token is None and self._start_future is None:
+      self._start_future = self._start_upload_async()
+
+  @ndb.tasklet
+  def _start_upload_async(self):
+    """Start the resumable upload.
+
+    This is a utility method that does not modify self.
+
+    Yields:
+      The path to the object with the upload token appended.
+    """
+    headers = self._object_headers()
+    headers['x-goog-resumable'] = 'start'
+    status, resp_headers, content = yield self._api.post_object_async(
+        self._path, headers=headers)
+    errors.check_status(status, [201], self._path, headers, resp_headers,
+                        body=content)
+    loc = resp_headers.get('location')
+    if not loc:
+      raise IOError('No location header found in 201 response')
+    parsed = urlparse.urlparse(loc)
+    raise ndb.Return('%s?%s' % (self._path, parsed.query))
+
+  def _object_headers(self):
+    """Returns the headers setting the content type and gs headers."""
+    headers = {}
+    if self._content_type:
+      headers['content-type'] = self._content_type
+    if self._gcs_headers:
+      headers.update(self._gcs_headers)
+    return headers
+
+  def _wait_for_upload_start(self):
+    """Start the resumable upload if needed and block until it has."""
+    self._start_upload()
+    if self._start_future is not None:
+      self._path_with_token = self._start_future.get_result()
+      self._start_future = None
+
+  def _wait_for_pending_put(self):
+    """Block until the chunk in flight, if any, has been accepted by GCS."""
+    if self._pending_put is not None:
+      future, self._pending_put = self._pending_put, None
+      future.get_result()
+
+  def __getstate__(self):
+    """Store state as part of serialization/pickling.
+
+    The contents of the write buffer are stored. Writes to the underlying
+    storage are required to be on block boundaries (_blocksize) except for the
+    last write. In the worst case the pickled version of this object may be
+    slightly larger than the blocksize.
+
+    Returns:
+      A dictionary with the state of this object
+
+    """
+    self._wait_for_upload_start()
+    self._wait_for_pending_put()
+    return {'api': self._api,
+            'path': self._path,
+            'path_token': self._path_with_token,
+            'buffer': self._buffer,
+            'buffered': self._buffered,
+            'written': self._written,
+            'offset': self._offset,
+            'closed': self.closed,
+            'checkpoint': self._checkpoint}
+
+  def __setstate__(self, state):
+    """Restore state as part of deserialization/unpickling.
 
     Args:
       state: the dictionary from a __getstate__ call
     """
     self._api = state['api']
+    self._content_type = None
+    self._gcs_headers = None
     self._path_with_token = state['path_token']
+    self._start_future = None
+    self._pending_put = None
     self._buffer = state['buffer']
+    if not isinstance(self._buffer, bytearray):
+      # pickled before the buffer was a bytearray
+      self._buffer = bytearray(''.join(self._buffer))
     self._buffered = state['buffered']
     self._written = state['written']
     self._offset = state['offset']
     self.closed = state['closed']
     self._path = state['path']
     self.name = api_utils._unquote_filename(self._path)
+    self._checkpoint = state.get('checkpoint')
+
+  @classmethod
+  def resume(cls, api, checkpoint_id, use_datastore=True):
+    """Reopen an upload saved with checkpoint().
+
+    Data that GCS had not received is lost, so writing has to continue from
+    tell(), the number of bytes GCS has committed.
+
+    Args:
+      api: A StorageApi instance.
+      checkpoint_id: the id passed to checkpoint().
+      use_datastore: False if checkpoint() was called with it False.
+
+    Returns:
+      A StreamingBuffer for the upload. Closing it deletes the checkpoint.
+
+    Raises:
+      errors.NotFoundError: if there is no checkpoint with this id, or it
+        was only in memcache and got evicted.
+      errors.Error: if GCS no longer knows the upload, e.g. because it was
+        finalized or expired.
+    """
+    checkpoint = _AE_UploadCheckpoint_.get_by_id(
+        checkpoint_id, use_cache=False, use_memcache=True,
+        use_datastore=use_datastore)
+    if checkpoint is None:
+      raise errors.NotFoundError('No upload checkpoint %s.' % checkpoint_id)
+    upload = cls.__new__(cls)
+    upload.__setstate__({'api': api,
+                         'path': checkpoint.path,
+                         'path_token': checkpoint.path_token,
+                         'buffer': bytearray(),
+                         'buffered': 0,
+                         'written': 0,
+                         'offset': 0,
+                         'closed': False,
+                         'checkpoint': (checkpoint_id, use_datastore)})
+    upload._written = upload._offset = upload._get_offset_from_gcs() + 1
+    return upload
+
+  def checkpoint(self, checkpoint_id, use_datastore=True):
+    """Save the upload session so another request can resume() it.
+
+    Flushes as much as possible first, so at most one block (256KB) of the
+    data written so far is not committed by GCS. The checkpoint is deleted
+    when the buffer is closed.
+
+    Args:
+      checkpoint_id: a str id for the checkpoint, unique among uploads.
+      use_datastore: If False, the checkpoint is kept in memcache only,
+        where it may be evicted.
+
+    Returns:
+      The number of bytes GCS has committed, where a resumed upload will
+      continue.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self.flush()
+    self._wait_for_upload_start()
+    _AE_UploadCheckpoint_(id=checkpoint_id, path=self._path,
+                          path_token=self._path_with_token).put(
+                              use_cache=False, use_memcache=True,
+                              use_datastore=use_datastore)
+    self._checkpoint = (checkpoint_id, use_datastore)
+    return self._written
 
   def write(self, data):
     """Write some bytes.
 
     Args:
-      data: data to write. str.
+      data: data to write. str, or any object supporting the buffer
+        protocol such as a bytearray or memoryview. It is copied before
+        write returns.
+
+    Raises:
+      TypeError: if data is unicode or doesn't support the buffer protocol.
+    """
+    for chunk in self._chunks(data):
+      if self._append(chunk):
+        self._flush()
+
+  @ndb.tasklet
+  def write_async(self, data):
+    """Async version of write().
+
+    Lets several buffers upload concurrently from one thread using tasklets.
+    Calls to the async methods of one buffer must not overlap: wait for each
+    future before making the next call.
+
+    Args:
+      data: data to write. str or any object supporting the buffer
+        protocol. It is copied before the returned future is done.
+
+    Returns:
+      A ndb Future that is done once data is buffered or sent.
 
     Raises:
-      TypeError: if data is not of type str.
+      TypeError: if data is unicode or doesn't support the buffer protocol.
     """
+    for chunk in self._chunks(data):
+      if self._append(chunk):
+        yield self._flush_async()
+
+  def _chunks(self, data):
+    """Split data into memoryviews of at most _flushsize bytes."""
     self._check_open()
-    if not isinstance(data, str):
-      raise TypeError('Expected str but got %s.' % type(data))
-    if not data:
-      return
-    self._buffer.append(data)
+    view = _byte_view(data)
+    for start in xrange(0, len(view), self._flushsize):
+      yield view[start:start + self._flushsize]
+
+  def _append(self, data):
+    """Add data to the buffer.
+
+    Args:
+      data: a memoryview of bytes.
+
+    Returns:
+      True if enough data is buffered that it should be flushed.
+    """
+    self._buffer += data
     self._buffered += len(data)
     self._offset += len(data)
-    if self._buffered >= self._flushsize:
-      self._flush()
+    if self._buffered > self._single_request_size:
+      self._start_upload()
+    return self._buffered >= self._flushsize
+
+  def copy_from(self, fileobj):
+    """Write the rest of a file-like object, one block at a time.
+
+    Every chunk is exactly _blocksize bytes (except the last), so _flush can
+    send them without splitting any, and no more than _flushsize bytes are
+    held in memory however large fileobj is.
+
+    Args:
+      fileobj: a file-like object open for reading, e.g. the file of a
+        cgi.FieldStorage upload.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    while True:
+      data = fileobj.read(self._blocksize)
+      if not data:
+        break
+      self.write(data)
+
+  @ndb.tasklet
+  def copy_from_async(self, fileobj):
+    """Async version of copy_from().
+
+    Args:
+      fileobj: a file-like object open for reading.
+
+    Returns:
+      A ndb Future that is done once all of fileobj is buffered or sent.
+    """
+    self._check_open()
+    while True:
+      data = fileobj.read(self._blocksize)
+      if not data:
+        break
+      yield self.write_async(data)
 
   def flush(self):
     """Flush as much as possible to GCS.
@@ -769,6 +2068,7 @@ class StreamingBuffer(object):
     """
     self._check_open()
     self._flush(finish=False)
+    self._wait_for_pending_put()
 
   def tell(self):
     """Return the total number of bytes passed to write() so far.
@@ -786,6 +2086,29 @@ class StreamingBuffer(object):
       self.closed = True
       self._flush(finish=True)
       self._buffer = None
+      if self._checkpoint is not None:
+        self._delete_checkpoint_async().get_result()
+
+  @ndb.tasklet
+  def close_async(self):
+    """Async version of close().
+
+    Returns:
+      A ndb Future that is done once the file is finalized.
+    """
+    if not self.closed:
+      self.closed = True
+      yield self._flush_async(finish=True)
+      self._buffer = None
+      if self._checkpoint is not None:
+        yield self._delete_checkpoint_async()
+
+  def _delete_checkpoint_async(self):
+    """Delete the checkpoint of this upload, now that it is finalized."""
+    checkpoint_id, use_datastore = self._checkpoint
+    self._checkpoint = None
+    return ndb.Key(_AE_UploadCheckpoint_, checkpoint_id).delete_async(
+        use_cache=False, use_memcache=True, use_datastore=use_datastore)
 
   def __enter__(self):
     return self
@@ -800,49 +2123,68 @@ class StreamingBuffer(object):
     Buffer is flushed to GCS only when the total amount of buffered data is at
     least self._blocksize, or to flush the final (incomplete) block of
     the file with finish=True.
+
+    One chunk is kept in flight: this returns as soon as the last chunk is
+    sent, so the caller can buffer more data meanwhile. The next flush waits
+    for it before sending, which keeps the chunks in order, and raises its
+    errors. With finish=True this returns once the file is finalized.
     """
+    self._flush_async(finish).get_result()
+
+  @ndb.tasklet
+  def _flush_async(self, finish=False):
+    """Async version of _flush()."""
+    if self._path_with_token is None and self._start_future is None:
+      if finish:
+        yield self._send_object_async()
+        return
+      if self._buffered < self._blocksize:
+        return
+      self._start_upload()
+    if self._start_future is not None:
+      self._path_with_token = yield self._start_future
+      self._start_future = None
+    sent = 0
     while ((finish and self._buffered >= 0) or
            (not finish and self._buffered >= self._blocksize)):
-      tmp_buffer = []
-      tmp_buffer_len = 0
-
-      excess = 0
-      while self._buffer:
-        buf = self._buffer.popleft()
-        size = len(buf)
-        self._buffered -= size
-        tmp_buffer.append(buf)
-        tmp_buffer_len += size
-        if tmp_buffer_len >= self._maxrequestsize:
-          excess = tmp_buffer_len - self._maxrequestsize
-          break
-        if not finish and (
-            tmp_buffer_len % self._blocksize + self._buffered <
-            self._blocksize):
-          excess = tmp_buffer_len % self._blocksize
-          break
+      size = min(self._buffered, self._maxrequestsize)
+      if not finish or size < self._buffered:
+        size -= size % self._blocksize
+      data = memoryview(self._buffer)[sent:sent + size].tobytes()
+      sent += size
+      self._buffered -= size
 
-      if excess:
-        over = tmp_buffer.pop()
-        size = len(over)
-        assert size >= excess
-        tmp_buffer_len -= size
-        head, tail = over[:-excess], over[-excess:]
-        self._buffer.appendleft(tail)
-        self._buffered += len(tail)
-        if head:
-          tmp_buffer.append(head)
-          tmp_buffer_len += len(head)
-
-      data = ''.join(tmp_buffer)
       file_len = '*'
       if finish and not self._buffered:
         file_len = self._written + len(data)
-      self._send_data(data, self._written, file_len)
+      if self._pending_put is not None:
+        future, self._pending_put = self._pending_put, None
+        yield future
+      self._pending_put = self._send_data_async(data, self._written, file_len)
       self._written += len(data)
       if file_len != '*':
         break
 
+    if sent:
+      del self._buffer[:sent]
+    if finish and self._pending_put is not None:
+      future, self._pending_put = self._pending_put, None
+      yield future
+
+  @ndb.tasklet
+  def _send_object_async(self):
+    """Send the whole file with a single PUT instead of a resumable upload."""
+    data = memoryview(self._buffer)[:self._buffered].tobytes()
+    headers = self._object_headers()
+    _set_local_content_range(headers, len(data))
+    status, response_headers, content = yield self._api.put_object_async(
+        self._path, payload=data, headers=headers)
+    errors.check_status(status, [200], self._path, headers,
+                        response_headers, content)
+    self._written = len(data)
+    self._buffered = 0
+    del self._buffer[:]
+
   def _send_data(self, data, start_offset, file_len):
     """Send the block to the storage service.
 
@@ -854,6 +2196,11 @@ class StreamingBuffer(object):
       file_len: an int if this is the last data to append to the file.
         Otherwise '*'.
     """
+    self._send_data_async(data, start_offset, file_len).get_result()
+
+  @ndb.tasklet
+  def _send_data_async(self, data, start_offset, file_len):
+    """Async version of _send_data()."""
     headers = {}
     end_offset = start_offset + len(data) - 1
 
@@ -863,7 +2210,7 @@ class StreamingBuffer(object):
     else:
       headers['content-range'] = ('bytes */%s' % file_len)
 
-    status, response_headers, content = self._api.put_object(
+    status, response_headers, content = yield self._api.put_object_async(
         self._path_with_token, payload=data, headers=headers)
     if file_len == '*':
       expected = 308
@@ -882,6 +2229,8 @@ class StreamingBuffer(object):
       an int of the last offset written to GCS by this upload, inclusive.
       -1 means nothing has been written.
     """
+    self._wait_for_upload_start()
+    self._wait_for_pending_put()
     headers = {'content-range': 'bytes */*'}
     status, response_headers, content = self._api.put_object(
         self._path_with_token, headers=headers)
@@ -906,6 +2255,8 @@ class StreamingBuffer(object):
       file_length: file length. Must match what has been uploaded. If None,
         it will be queried from GCS.
     """
+    self._wait_for_upload_start()
+    self._wait_for_pending_put()
     if file_length is None:
       file_length = self._get_offset_from_gcs() + 1
     self._send_data('', 0, file_length)
@@ -922,3 +2273,263 @@ class StreamingBuffer(object):
 
   def writable(self):
     return True
+
+
+class ParallelStreamingBuffer(object):
+  """A class for creating large objects from parts uploaded in parallel.
+
+  Written data is cut into part_size parts. Every part is uploaded to a
+  temporary object in the same bucket through its own resumable upload
+  (a StreamingBuffer), up to parallel parts at once. close() composes the
+  parts into the object, through intermediate composites when there are
+  more than 32, and deletes the temporary objects whether or not that
+  succeeded. An object that fits in one part is uploaded directly.
+
+  Memory use is bounded by about (parallel + 1) * part_size.
+  """
+
+  _part_size = 8 * 1024 * 1024
+
+  _max_compose = 32
+
+  _max_parts = 1024
+
+  def __init__(self,
+               api,
+               path,
+               content_type=None,
+               gcs_headers=None,
+               parallel=4,
+               part_size=None):
+    """Constructor.
+
+    Args:
+      api: A StorageApi instance.
+      path: Quoted/escaped path to the object, e.g. /mybucket/myfile
+      content_type: Optional content-type; Default value is
+        delegate to Google Cloud Storage.
+      gcs_headers: additional gs headers as a str->str dict, e.g
+        {'x-goog-acl': 'private', 'x-goog-meta-foo': 'foo'}. Applied to the
+        final object only.
+      parallel: max number of parts uploading at once.
+      part_size: size of a part. At most 1024 parts can be composed, so this
+        limits the size of the object to 1024 * part_size.
+    """
+    self._api = api
+    self._path = path
+    self.name = api_utils._unquote_filename(path)
+    self.closed = False
+
+    self._content_type = content_type
+    self._gcs_headers = gcs_headers
+    self._parallel = max(1, parallel)
+    if part_size:
+      self._part_size = part_size
+
+    self._bucket, object_name = self.name[1:].split('/', 1)
+    self._temp_prefix = '%s.parallel-upload-%s-' % (
+        object_name, os.urandom(8).encode('hex'))
+    self._buffer = []
+    self._buffered = 0
+    self._offset = 0
+    self._parts = []
+    self._temp_files = []
+    self._uploads = []
+
+  def __getstate__(self):
+    raise TypeError('A ParallelStreamingBuffer can not be pickled.')
+
+  def write(self, data):
+    """Write some bytes.
+
+    Blocks only while parallel parts are already uploading.
+
+    Args:
+      data: data to write. str, or any object supporting the buffer
+        protocol, which is then copied.
+
+    Raises:
+      TypeError: if data is unicode or doesn't support the buffer protocol.
+    """
+    self._check_open()
+    if not isinstance(data, str):
+      data = _byte_view(data).tobytes()
+    while data:
+      # a full part is only sent once more data comes, so close() always
+      # has a last part to compose with it.
+      if self._buffered == self._part_size:
+        self._start_part()
+      size = min(len(data), self._part_size - self._buffered)
+      if size < len(data):
+        piece, data = data[:size], data[size:]
+      else:
+        piece, data = data, ''
+      self._buffer.append(piece)
+      self._buffered += size
+      self._offset += size
+
+  def copy_from(self, fileobj):
+    """Write the rest of a file-like object.
+
+    Args:
+      fileobj: a file-like object open for reading.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    while True:
+      data = fileobj.read(StreamingBuffer._flushsize)
+      if not data:
+        break
+      self.write(data)
+
+  def flush(self):
+    """Does nothing. Parts are only sent once they are full."""
+    self._check_open()
+
+  def tell(self):
+    """Return the total number of bytes passed to write() so far."""
+    return self._offset
+
+  def close(self):
+    """Upload the last part, compose the object and delete the parts.
+
+    When this returns the new file is available for reading.
+    """
+    if self.closed:
+      return
+    self.closed = True
+    if not self._parts:
+      with StreamingBuffer(self._api, self._path, self._content_type,
+                           self._gcs_headers) as gcs_file:
+        for piece in self._buffer:
+          gcs_file.write(piece)
+      self._buffer = None
+      return
+
+    try:
+      self._start_part()
+      self._wait_for_uploads(0)
+      self._compose()
+    finally:
+      self._cleanup()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, atype, value, traceback):
+    if atype is None:
+      self.close()
+    elif not self.closed:
+      self.closed = True
+      self._cleanup()
+    return False
+
+  def _start_part(self):
+    """Start uploading the buffered data as the next part."""
+    if len(self._parts) == self._max_parts:
+      self.closed = True
+      self._cleanup()
+      raise ValueError('Can not compose more than %d parts of %d bytes.' %
+                       (self._max_parts, self._part_size))
+    self._wait_for_uploads(self._parallel - 1)
+    name = '%s%05d' % (self._temp_prefix, len(self._parts))
+    self._parts.append(name)
+    self._temp_files.append(name)
+    self._uploads.append(self._upload_part_async(name, self._buffer))
+    self._buffer = []
+    self._buffered = 0
+
+  @ndb.tasklet
+  def _upload_part_async(self, name, pieces):
+    """Upload pieces as the temporary object name, in its own session."""
+    gcs_file = StreamingBuffer(self._api, self._temp_path(name))
+    for piece in pieces:
+      yield gcs_file.write_async(piece)
+    yield gcs_file.close_async()
+
+  def _wait_for_uploads(self, max_in_flight):
+    """Wait until at most max_in_flight part uploads are running.
+
+    Raises:
+      The error of a failed upload. The buffer is then closed and the
+      temporary objects are deleted.
+    """
+    try:
+      while len(self._uploads) > max_in_flight:
+        ndb.Future.wait_any(self._uploads)
+        running = []
+        for future in self._uploads:
+          if future.done():
+            future.check_success()
+          else:
+            running.append(future)
+        self._uploads = running
+    except Exception:
+      self.closed = True
+      self._cleanup()
+      raise
+
+  def _compose(self):
+    """Compose the parts into the object, 32 at a time."""
+    names = self._parts
+    level = 0
+    while len(names) > self._max_compose:
+      composites = []
+      for i in xrange(0, len(names), self._max_compose):
+        group = names[i:i + self._max_compose]
+        if len(group) == 1:
+          composites.append(group[0])
+          continue
+        name = '%scompose-%d-%05d' % (self._temp_prefix, level, len(composites))
+        self._temp_files.append(name)
+        self._compose_into(group, '/%s/%s' % (self._bucket, name))
+        composites.append(name)
+      names = composites
+      level += 1
+    self._compose_into(names, self.name, self._content_type,
+                       self._gcs_headers)
+
+  def _compose_into(self, names, destination, content_type=None,
+                    gcs_headers=None):
+    file_list = [{'Name': saxutils.escape(name)} for name in names]
+    self._api.compose_object(file_list, destination, content_type,
+                             gcs_headers)
+
+  def _cleanup(self):
+    """Wait for the part uploads, then delete all temporary objects.
+
+    Errors are logged, not raised, as this also runs while handling one.
+    """
+    ndb.Future.wait_all(self._uploads)
+    self._uploads = []
+    self._buffer = None
+    futures = [(name, self._api.delete_object_async(self._temp_path(name)))
+               for name in self._temp_files]
+    self._temp_files = []
+    for name, future in futures:
+      try:
+        status, _, _ = future.get_result()
+        if status not in (204, 404):
+          logging.warning('Could not delete temporary object %s: %s',
+                          name, status)
+      except Exception, e:
+        logging.warning('Could not delete temporary object %s: %s', name, e)
+
+  def _temp_path(self, name):
+    """Returns the quoted path of the temporary object name."""
+    return api_utils._quote_filename('/%s/%s' % (self._bucket, name))
+
+  def _check_open(self):
+    if self.closed:
+      raise IOError('Buffer is closed.')
+
+  def seekable(self):
+    return False
+
+  def readable(self):
+    return False
+
+  def writable(self):
+    return True
@@ -19,14 +19,20 @@ import jinja2
 from hashlib import sha1
 import time, os, json, base64, hmac, urllib
 from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext.webapp import blobstore_handlers
 import lib.cloudstorage as gcs
 import logging
+import uuid
 # from google.appengine.api import app_identity
 from datetime import datetime
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
 import secrets
 from database.gcs_file import GCSFile
+from database.gcs_file_name import GCSFileName
+from database import file_cache
 from database.file_deletes import FileDeletes
 
 
@@ -41,6 +47,18 @@ template_dir = os.path.join(os.path.dirname(__file__), '')
 jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir),
                                autoescape = True, variable_start_string='@|', variable_end_string='|@')
 
+# cap on the gcs requests a single handler keeps in flight at once
+MAX_CONCURRENT_GCS_REQUESTS = 20
+# a StreamingBuffer holds up to _flushsize bytes plus the request it is sending
+UPLOAD_MEMORY_BUDGET = 32 * 1024 * 1024
+MAX_CONCURRENT_UPLOADS = max(1, min(8, UPLOAD_MEMORY_BUDGET // (2 * gcs.StreamingBuffer._flushsize)))
+# the python27 runtime buffers whole responses and caps them at 32MB
+MAX_RESPONSE_BYTES = 32 * 1024 * 1024
+# more ranges than this in one request get the whole file instead
+MAX_RANGES = 16
+# every delete is written to the one App/deepSpace9 entity group
+MAX_BATCH_DELETE_IDS = 500
+
 if os.environ.get('SERVER_SOFTWARE','').startswith('Development'):
     DEBUG = True
 else:
@@ -70,6 +88,205 @@ class BaseHandler(webapp2.RequestHandler):
         self.write(")]}',\n" + json_txt)
 
 
+@ndb.tasklet
+def map_async(tasklet, items, max_in_flight=MAX_CONCURRENT_GCS_REQUESTS):
+    """Run tasklet(item) for every item, at most max_in_flight at a time.
+
+    Returns:
+      A future of the list of results, in the same order as items.
+    """
+    results = [None] * len(items)
+    todo = iter(enumerate(items))
+
+    @ndb.tasklet
+    def worker():
+        for i, item in todo:
+            results[i] = yield tasklet(item)
+
+    yield [worker() for _ in range(min(max_in_flight, len(items)))]
+    raise ndb.Return(results)
+
+
+@ndb.tasklet
+def gcs_file_exists_async(filename):
+    try:
+        yield gcs.stat_async(filename)
+    except gcs.NotFoundError:
+        raise ndb.Return(False)
+    raise ndb.Return(True)
+
+
+@ndb.tasklet
+def save_gcs_files_async(uploads, user_name, user_id):
+    """Save the GCSFile entries of uploaded files, reusing the entries of files they replace.
+
+    The files are checked concurrently, and each one found in gcs is then looked
+    up in the database. The entries are saved with a single put_multi, and the
+    index entries of new files after that.
+
+    Args:
+      uploads: a list of (gcs_file_name, original_file_name) tuples.
+
+    Returns:
+      A future of a tuple of two lists in the order of uploads: the saved GCSFile
+      entities, and whether each one was newly created. An entity is None if
+      that file exists in gcs but has no database entry.
+    """
+    @ndb.tasklet
+    def find_async(filename):
+        # only a file already in gcs can have an entry to reuse, so new files
+        # never run the lookup, which may index an old entry of the same name
+        file_exists = yield gcs_file_exists_async(filename)
+        db_gcs_file = None
+        if file_exists:
+            db_gcs_file = yield GCSFile.get_by_gcs_file_name_async(filename)
+        raise ndb.Return((file_exists, db_gcs_file))
+
+    found = yield map_async(find_async, [filename for filename, _ in uploads])
+
+    db_gcs_files = []
+    created = []
+    for (filename, original_file_name), (file_exists, db_gcs_file) in zip(uploads, found):
+        if file_exists:
+            if db_gcs_file:
+                db_gcs_file.user_id = user_id
+                db_gcs_file.user_name = user_name
+                db_gcs_file.original_file_name = original_file_name
+                db_gcs_file.gcs_file_name = filename
+                db_gcs_file.timestamp = datetime.now()
+                logging.error(db_gcs_file.key.id())
+        else:
+            # write a new entry in the DB
+            db_gcs_file = GCSFile.save_new(user_id=user_id, user_name=user_name, original_file_name=original_file_name,
+                                           gcs_file_name=filename)
+        db_gcs_files.append(db_gcs_file)
+        created.append(not file_exists)
+
+    # save to database
+    yield ndb.put_multi_async([f for f in db_gcs_files if f])
+    yield ndb.put_multi_async([GCSFileName.save_new(f.gcs_file_name, f.key.id())
+                               for f, new in zip(db_gcs_files, created) if new])
+    raise ndb.Return((db_gcs_files, created))
+
+
+def delete_gcs_files(db_gcs_files):
+    """Delete GCSFile entries and their index entries, for uploads that failed."""
+    ndb.delete_multi([f.key for f in db_gcs_files] +
+                     [GCSFileName.key_for(f.gcs_file_name) for f in db_gcs_files])
+
+
+def parse_range_header(range_header, size):
+    """Parse an HTTP Range header into inclusive (start, end) byte offsets.
+
+    Returns None when there is no usable bytes Range header, in which case the
+    whole file should be sent, and an empty list when none of the requested
+    ranges can be satisfied for a file of this size.
+    """
+    if not range_header:
+        return None
+    units, _, range_set = range_header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in range_set.split(','):
+        first, dash, last = spec.strip().partition('-')
+        first, last = first.strip(), last.strip()
+        if not dash or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+        elif last:
+            # suffix range, the last n bytes of the file
+            if int(last) == 0:
+                continue
+            start = max(size - int(last), 0)
+            end = size - 1
+        else:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    return ranges
+
+
+def coalesce_ranges(ranges):
+    """Sort ranges and merge the ones that overlap or touch.
+
+    Clients may ask for overlapping or out of order ranges; merging them means
+    no byte is read or sent twice.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def http_date_to_posix(http_date):
+    """Parse an HTTP date header value, returning None if it is malformed."""
+    parsed = parsedate_tz(http_date) if http_date else None
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+def multipart_byteranges(ranges, content_type, size):
+    """Lay out a multipart/byteranges body for GCSFileIterator.
+
+    Returns a tuple of (boundary, parts, trailer, content_length) where parts is
+    a list of (part_header, start, end) to pass to GCSFileIterator.
+    """
+    boundary = uuid.uuid4().hex
+    # stats can have unicode content types, and WSGI bodies must be bytes
+    content_type = str(content_type)
+    parts = []
+    content_length = 0
+    for start, end in ranges:
+        part_header = '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+            boundary, content_type, start, end, size)
+        parts.append((part_header, start, end))
+        content_length += len(part_header) + end - start + 1
+    trailer = '\r\n--%s--\r\n' % boundary
+    content_length += len(trailer)
+    return boundary, parts, trailer, content_length
+
+
+class GCSFileIterator(object):
+    """WSGI app_iter sending byte ranges of an open gcs read buffer.
+
+    The python27 runtime does not stream responses: it collects the whole
+    app_iter before sending it and caps responses at 32MB. So this is only
+    used for bodies that have to be built in the instance, like multipart
+    range replies; whole files are served with send_blob instead. The WSGI
+    server calls close() once the response is done.
+
+    parts is a list of (part_header, start, end) with inclusive offsets. Each
+    part_header is sent before its range and the trailer after the last one.
+    The ranges are all fetched at once with read_ranges, so open the file
+    lazily to make no other request.
+    """
+    def __init__(self, gcs_file, parts, trailer=''):
+        self.gcs_file = gcs_file
+        self.parts = parts
+        self.trailer = trailer
+
+    def __iter__(self):
+        contents = self.gcs_file.read_ranges([(start, end) for _, start, end in self.parts])
+        for (part_header, _, _), content in zip(self.parts, contents):
+            if part_header:
+                yield part_header
+            yield content
+        if self.trailer:
+            yield self.trailer
+
+    def close(self):
+        self.gcs_file.close()
+
+
 class MainHandler(BaseHandler):
     def get(self):
         # self.write(secrets.test)
@@ -105,39 +322,135 @@ class BlobStoreDemo(BaseHandler, blobstore_handlers.BlobstoreUploadHandler):
         self.render('templates/blobstore-demo.html', upload_url=upload_url)
 
 
-class GCS(BaseHandler):
+class GCS(BaseHandler, blobstore_handlers.BlobstoreDownloadHandler):
     def initialize(self, *a, **kw):
         BaseHandler.initialize(self, *a, **kw)
         if self.request.headers.get('Origin') and self.request.headers.get('Origin') in self.approved_origins:
             self.response.headers.add_header('Access-Control-Allow-Origin', self.request.headers['Origin'])
 
     def options(self):
-        self.response.headers['Access-Control-Allow-Headers'] = 'Origin, X-Requested-With, Content-Type, Accept, Firebase-User-Id'
+        self.response.headers['Access-Control-Allow-Headers'] = 'Origin, X-Requested-With, Content-Type, Accept, Firebase-User-Id, Range, If-Range, If-None-Match, If-Modified-Since'
         self.response.headers['Access-Control-Allow-Methods'] = 'POST, GET, DELETE'
 
     def get(self):
         file_id = self.request.get('fileId')
         if file_id and file_id.isdigit():
-            # get the gcs_file_name from the database
-            db_gcs_file = GCSFile.get(int(file_id))
-            if db_gcs_file:
-                # check if it exists in gcs
-                try:
-                    stat = gcs.stat(db_gcs_file.gcs_file_name)
-                except gcs.NotFoundError:
+            file_id = int(file_id)
+            # a cached stat saves both the database get and the gcs HEAD
+            cached_stat = file_cache.get(file_id)
+            if cached_stat:
+                gcs_file_name = cached_stat.filename
+            else:
+                # get the gcs_file_name from the database
+                db_gcs_file = GCSFile.get(file_id)
+                if not db_gcs_file:
                     self.response.set_status(404)
                     self.write('404: This file does not exist')
-                else:
-                    # return it if it does
-                    gcs_file = gcs.open(db_gcs_file.gcs_file_name)
-                    self.response.headers['Content-Type'] = stat.content_type
-                    self.response.headers['Content-Disposition'] = "attachment; filename=" + stat.metadata[
-                        'x-goog-meta-original-name']
-                    self.response.write(gcs_file.read())
-                    gcs_file.close()
-            else:
+                    return
+                gcs_file_name = db_gcs_file.gcs_file_name
+
+            # check if it exists in gcs
+            stat = cached_stat
+            try:
+                if not stat or self.is_conditional_or_partial():
+                    # ranges and validators have to match the object that is sent,
+                    # which may have been replaced since it was cached
+                    stat = gcs.stat(gcs_file_name)
+            except gcs.NotFoundError:
+                file_cache.invalidate(file_id)
                 self.response.set_status(404)
                 self.write('404: This file does not exist')
+                return
+            if not cached_stat or cached_stat.etag != stat.etag:
+                file_cache.put(file_id, stat)
+
+            self.set_validator_headers(stat)
+            if self.not_modified(stat):
+                # the client's copy is still current
+                self.response.set_status(304)
+            else:
+                # send it back if it does
+                self.send_gcs_file(gcs_file_name, stat)
+
+    def is_conditional_or_partial(self):
+        headers = self.request.headers
+        return 'If-None-Match' in headers or 'If-Modified-Since' in headers or 'Range' in headers
+
+    def set_validator_headers(self, stat):
+        """Set the headers clients use to revalidate their cached copy of a file."""
+        self.response.headers['ETag'] = '"%s"' % stat.etag
+        self.response.headers['Last-Modified'] = formatdate(stat.st_ctime, usegmt=True)
+        # uploads can replace the file behind a fileId so caches must revalidate
+        self.response.headers['Cache-Control'] = 'private, no-cache'
+
+    def not_modified(self, stat):
+        """Whether If-None-Match or If-Modified-Since say the client's copy is current."""
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match:
+            etags = [etag.strip() for etag in if_none_match.split(',')]
+            if '*' in etags:
+                return True
+            return any(etag.replace('W/', '', 1).strip('"') == stat.etag for etag in etags)
+        if_modified_since = http_date_to_posix(self.request.headers.get('If-Modified-Since'))
+        return if_modified_since is not None and int(stat.st_ctime) <= if_modified_since
+
+    def if_range_matches(self, stat):
+        """Whether a Range request may be answered with a partial response.
+
+        An If-Range etag or date that no longer matches the file means the client's
+        partial copy is stale, so the whole file has to be sent instead.
+        """
+        if_range = self.request.headers.get('If-Range')
+        if not if_range:
+            return True
+        if if_range.startswith('W/'):
+            return False
+        if if_range.startswith('"'):
+            return if_range.strip('"') == stat.etag
+        return http_date_to_posix(if_range) == int(stat.st_ctime)
+
+    def send_gcs_file(self, gcs_file_name, stat):
+        """Send a gcs file back, honouring Range and If-Range headers.
+
+        The whole file or a single range is sent with send_blob, so the bytes go
+        from gcs to the client without passing through the instance. Ranges
+        are sorted and merged, and more than MAX_RANGES of them get the whole
+        file. Several ranges are read in the instance into a multipart reply,
+        unless that would go over MAX_RESPONSE_BYTES, in which case the whole
+        file is sent too.
+        """
+        ranges = None
+        if self.if_range_matches(stat):
+            ranges = parse_range_header(self.request.headers.get('Range'), stat.st_size)
+        if ranges:
+            ranges = coalesce_ranges(ranges)
+            if len(ranges) > MAX_RANGES:
+                ranges = None
+        if ranges == []:
+            self.response.set_status(416)
+            self.response.headers['Content-Range'] = 'bytes */%d' % stat.st_size
+            return
+
+        self.response.headers['Accept-Ranges'] = 'bytes'
+        self.response.headers['Access-Control-Expose-Headers'] = 'Accept-Ranges, Content-Range, Content-Length, ETag, Last-Modified'
+        self.response.headers['Content-Disposition'] = "attachment; filename=" + stat.metadata[
+            'x-goog-meta-original-name']
+        if ranges and len(ranges) > 1:
+            boundary, parts, trailer, content_length = multipart_byteranges(ranges, stat.content_type,
+                                                                            stat.st_size)
+            if content_length <= MAX_RESPONSE_BYTES:
+                gcs_file = gcs.open(gcs_file_name, lazy=True)
+                self.response.set_status(206)
+                self.response.app_iter = GCSFileIterator(gcs_file, parts, trailer)
+                self.response.headers['Content-Type'] = 'multipart/byteranges; boundary=' + boundary
+                self.response.headers['Content-Length'] = str(content_length)
+                return
+            ranges = None
+
+        # blob serving sets the status, Content-Length and Content-Range
+        start, end = ranges[0] if ranges else (None, None)
+        self.send_blob(blobstore.create_gs_key('/gs' + gcs_file_name), content_type=stat.content_type,
+                       start=start, end=end, use_range=False)
 
     def post(self):
         reportFile = self.request.POST['file_input']
@@ -155,36 +468,7 @@ class GCS(BaseHandler):
         bucket = '/' + bucket_name + '/' + folder_name
         filename = bucket + '/' + reportFile.filename
 
-        # Check if the file already exists in google cloud storage
-        exists = True
-        try:
-            gcs.stat(filename)
-        except gcs.NotFoundError:
-            exists = False
-
-        if exists:
-            # find it in the database and get its key
-            files = GCSFile.get_by_gcs_file_name(filename)
-            if len(files) == 1:
-                db_gcs_file = files[0]
-                db_gcs_file.user_id = user_id
-                db_gcs_file.user_name = user_name
-                db_gcs_file.original_file_name = reportFile.filename
-                db_gcs_file.gcs_file_name = filename
-                db_gcs_file.timestamp = datetime.now()
-                logging.error(db_gcs_file.key.id())
-            else:
-                self.response.set_status(500)
-                self.render_json({'status': 'error', 'key': '', 'reason': 'Unexpected number of files found in the database'})
-                return
-        else:
-            # write a new entry in the DB
-            db_gcs_file = GCSFile.save_new(user_id=user_id, user_name=user_name, original_file_name=reportFile.filename,
-                                        gcs_file_name=filename)
-        # save to database
-        db_gcs_file.put()
-
-        # write the file to GCS
+        # the database work runs while the file is written to GCS
         write_retry_params = gcs.RetryParams(backoff_factor=1.1)
         gcs_file = gcs.open(filename,
                             'w',
@@ -193,8 +477,26 @@ class GCS(BaseHandler):
                                      'x-goog-meta-user-id': user_id,
                                      'x-goog-meta-original-name': str(reportFile.filename)},
                             retry_params=write_retry_params)
-        gcs_file.write(reportFile.value)
-        gcs_file.close()
+        db_gcs_files_future = save_gcs_files_async([(filename, reportFile.filename)], user_name, user_id)
+
+        # write the file to GCS
+        try:
+            gcs_file.copy_from(reportFile.file)
+            # only finish the upload once the database is known to be in order
+            db_gcs_files, created = db_gcs_files_future.get_result()
+            db_gcs_file = db_gcs_files[0]
+            if not db_gcs_file:
+                self.response.set_status(500)
+                self.render_json({'status': 'error', 'key': '', 'reason': 'File exists but was not found in the database'})
+                return
+            gcs_file.close()
+        except gcs.Error:
+            # don't leave an entry pointing at a file that was never written
+            db_gcs_files, created = db_gcs_files_future.get_result()
+            if created[0]:
+                delete_gcs_files(db_gcs_files)
+            raise
+        file_cache.invalidate(db_gcs_file.key.id())
         # # reply to the app with success and the key
         self.render_json({'status': 'success', 'id': db_gcs_file.key.id()})
 
@@ -214,13 +516,160 @@ class GCS(BaseHandler):
                     FileDeletes.save_new(user_id=user_id, gcs_file_name=db_gcs_file.gcs_file_name,
                                          original_file_name=db_gcs_file.original_file_name).put_async()
                     # delete from the database
-                    db_gcs_file.key.delete()
+                    ndb.delete_multi([db_gcs_file.key, GCSFileName.key_for(db_gcs_file.gcs_file_name)])
+                    file_cache.invalidate(db_gcs_file.key.id())
                     self.response.set_status(204)
             else:
                 self.response.set_status(400)
                 self.write('404: This file does not exist')
 
 
+class GCSBatchDelete(BaseHandler):
+    """Delete many files in one request, one fileId parameter per file.
+
+    Replies with the outcome for each id: deleted, not_found, invalid or error.
+    Ids must be written without leading zeros, and at most MAX_BATCH_DELETE_IDS
+    can be sent at once.
+    """
+    def initialize(self, *a, **kw):
+        BaseHandler.initialize(self, *a, **kw)
+        if self.request.headers.get('Origin') and self.request.headers.get('Origin') in self.approved_origins:
+            self.response.headers.add_header('Access-Control-Allow-Origin', self.request.headers['Origin'])
+
+    def options(self):
+        self.response.headers['Access-Control-Allow-Headers'] = 'Origin, X-Requested-With, Content-Type, Accept, Firebase-User-Id'
+        self.response.headers['Access-Control-Allow-Methods'] = 'POST'
+
+    def post(self):
+        file_ids = self.request.get_all('fileId')
+        user_id = self.request.headers.get('Firebase-User-Id')
+        if not file_ids or not user_id:
+            self.response.set_status(400)
+            self.render_json({'reason': 'Not all required parameters found', 'status': 'error'})
+            return
+        if len(file_ids) > MAX_BATCH_DELETE_IDS:
+            self.response.set_status(400)
+            self.render_json({'reason': 'At most %d files can be deleted at once' % MAX_BATCH_DELETE_IDS,
+                              'status': 'error'})
+            return
+
+        results = dict((file_id, 'invalid') for file_id in file_ids)
+        # only canonical ids, so no two of them name the same file
+        valid_ids = dict((int(file_id), file_id) for file_id in file_ids
+                         if file_id.isdigit() and str(int(file_id)) == file_id)
+        db_gcs_files = []
+        for file_id, db_gcs_file in zip(valid_ids, GCSFile.get_multi(valid_ids)):
+            if db_gcs_file:
+                db_gcs_files.append(db_gcs_file)
+            else:
+                results[valid_ids[file_id]] = 'not_found'
+
+        # delete from gcs a window of files at a time
+        statuses = map_async(self.delete_from_gcs_async, db_gcs_files).get_result()
+        deleted = []
+        for db_gcs_file, status in zip(db_gcs_files, statuses):
+            results[valid_ids[db_gcs_file.key.id()]] = status
+            if status == 'deleted':
+                deleted.append(db_gcs_file)
+
+        # log the deletes and delete from the database
+        futures = ndb.put_multi_async([FileDeletes.save_new(user_id=user_id, gcs_file_name=f.gcs_file_name,
+                                                            original_file_name=f.original_file_name)
+                                       for f in deleted])
+        futures.extend(ndb.delete_multi_async([f.key for f in deleted] +
+                                              [GCSFileName.key_for(f.gcs_file_name) for f in deleted]))
+        for future in futures:
+            future.get_result()
+        file_cache.invalidate_multi([f.key.id() for f in deleted])
+        self.render_json({'status': 'success', 'results': results})
+
+    @ndb.tasklet
+    def delete_from_gcs_async(self, db_gcs_file):
+        try:
+            yield gcs.delete_async(db_gcs_file.gcs_file_name)
+        except gcs.NotFoundError:
+            raise ndb.Return('not_found')
+        except gcs.Error:
+            logging.exception('Could not delete %s', db_gcs_file.gcs_file_name)
+            raise ndb.Return('error')
+        raise ndb.Return('deleted')
+
+
+class GCSMultiUpload(BaseHandler):
+    """Upload many files, each sent as a file_input field of one multipart request.
+
+    Files are uploaded to gcs concurrently, MAX_CONCURRENT_UPLOADS at a time, and
+    the reply has the outcome of each file in the order they were sent.
+    """
+    def initialize(self, *a, **kw):
+        BaseHandler.initialize(self, *a, **kw)
+        if self.request.headers.get('Origin') and self.request.headers.get('Origin') in self.approved_origins:
+            self.response.headers.add_header('Access-Control-Allow-Origin', self.request.headers['Origin'])
+
+    def options(self):
+        self.response.headers['Access-Control-Allow-Headers'] = 'Origin, X-Requested-With, Content-Type, Accept'
+        self.response.headers['Access-Control-Allow-Methods'] = 'POST'
+
+    def post(self):
+        report_files = [f for f in self.request.POST.getall('file_input') if getattr(f, 'filename', None)]
+        folder_name = self.request.get('folderName')
+        user_name = self.request.get('userName')
+        user_id = self.request.get('userId')
+
+        if not report_files or not folder_name or not user_name or not user_id:
+            self.response.set_status(400)
+            self.render_json({'reason': 'Not all required parameters found', 'status': 'error'})
+            return
+        file_names = [f.filename for f in report_files]
+        if len(set(file_names)) != len(file_names):
+            self.response.set_status(400)
+            self.render_json({'reason': 'The same file name was sent more than once', 'status': 'error'})
+            return
+
+        bucket_name = os.environ.get('BUCKET_NAME', 'deepspace9-1134.appspot.com')
+        bucket = '/' + bucket_name + '/' + folder_name
+        uploads = [(bucket + '/' + f.filename, f.filename) for f in report_files]
+        db_gcs_files_future = save_gcs_files_async(uploads, user_name, user_id)
+
+        @ndb.tasklet
+        def upload_async(i):
+            report_file = report_files[i]
+            filename = uploads[i][0]
+            result = {'name': report_file.filename, 'status': 'error'}
+            try:
+                write_retry_params = gcs.RetryParams(backoff_factor=1.1)
+                gcs_file = gcs.open(filename,
+                                    'w',
+                                    content_type=report_file.type,
+                                    options={'x-goog-meta-user-name': user_name,
+                                             'x-goog-meta-user-id': user_id,
+                                             'x-goog-meta-original-name': str(report_file.filename)},
+                                    retry_params=write_retry_params)
+                yield gcs_file.copy_from_async(report_file.file)
+                # only finish the upload once the database is known to be in order
+                db_gcs_file = (yield db_gcs_files_future)[0][i]
+                if not db_gcs_file:
+                    result['reason'] = 'File exists but was not found in the database'
+                    raise ndb.Return(result)
+                yield gcs_file.close_async()
+                file_cache.invalidate(db_gcs_file.key.id())
+            except gcs.Error:
+                logging.exception('Could not upload %s', filename)
+                result['reason'] = 'Could not write the file to storage'
+                raise ndb.Return(result)
+            result.update({'status': 'success', 'id': db_gcs_file.key.id()})
+            raise ndb.Return(result)
+
+        results = map_async(upload_async, range(len(report_files)), MAX_CONCURRENT_UPLOADS).get_result()
+        # don't leave entries pointing at files that were never written
+        db_gcs_files, created = db_gcs_files_future.get_result()
+        failed = [f for f, new, result in zip(db_gcs_files, created, results)
+                  if new and result['status'] != 'success']
+        if failed:
+            delete_gcs_files(failed)
+        self.render_json({'status': 'success', 'files': results})
+
+
 class GCSManualDelete(BaseHandler):
     def post(self):
         file_name = self.request.get('fileName')
@@ -236,7 +685,27 @@ class GCSManualDelete(BaseHandler):
             self.write('no')
 
 
-class GCSDemo(BaseHandler):
+class GCSIndexFileNames(BaseHandler):
+    """Migration creating the GCSFileName index for files uploaded before it existed.
+
+    Lookups index the files they find without an entry, so running it is
+    optional; it only saves those lookups the slower query. Each call indexes
+    one batch; call it again with the returned cursor until the cursor comes
+    back empty.
+    """
+    def post(self):
+        secret = self.request.get('secret')
+        if secret == secrets.Google_Frontend:
+            cursor = self.request.get('cursor')
+            cursor = Cursor(urlsafe=cursor) if cursor else None
+            count, next_cursor = GCSFile.index_file_names(cursor)
+            self.render_json({'status': 'success', 'indexed': count,
+                              'cursor': next_cursor.urlsafe() if next_cursor else ''})
+        else:
+            self.write('no')
+
+
+class GCSDemo(BaseHandler, blobstore_handlers.BlobstoreDownloadHandler):
     def initialize(self, *a, **kw):
         BaseHandler.initialize(self, *a, **kw)
         if self.request.headers.get('Origin') and self.request.headers.get('Origin') in self.approved_origins:
@@ -280,14 +749,11 @@ class GCSDemo(BaseHandler):
                             options={'x-goog-meta-foo': 'foo',
                                      'x-goog-meta-bar': 'bar'},
                             retry_params=write_retry_params)
-        gcs_file.write(reportFile.value)
+        gcs_file.copy_from(reportFile.file)
         gcs_file.close()
         # # echo the file back
-        gcs_file = gcs.open(filename)
-        self.response.headers['Content-Type'] = reportFile.type
         self.response.headers['Content-Disposition'] = "attachment; filename=" + str(reportFile.filename)
-        self.response.write(gcs_file.read())
-        gcs_file.close()
+        self.send_blob(blobstore.create_gs_key('/gs' + filename), content_type=reportFile.type)
 
 
 class GCSGitDemo(BaseHandler):
@@ -491,5 +957,8 @@ app = webapp2.WSGIApplication([
     ('/gcs-demo', GCSDemo),
     ('/ndb-demo', NDBDemo),
     ('/gcs-manual-delete', GCSManualDelete),
+    ('/gcs-batch-delete', GCSBatchDelete),
+    ('/gcs-multi-upload', GCSMultiUpload),
+    ('/gcs-index-file-names', GCSIndexFileNames),
     ('/gcs', GCS),
 ], debug=DEBUG)
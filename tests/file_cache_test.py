@@ -0,0 +1,76 @@
+"""Tests for the two tier cache of file stats in database/file_cache.py."""
+
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+from database import file_cache
+from lib.cloudstorage import common
+
+
+def _stat(etag):
+  return common.GCSFileStat('/bucket/file', 4, etag, 0, content_type='text/plain')
+
+
+class FileCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    file_cache._local.clear()
+
+  def tearDown(self):
+    file_cache._local.clear()
+    self.testbed.deactivate()
+
+  def testGetAndPut(self):
+    self.assertEqual(None, file_cache.get(1))
+    self.assertTrue(file_cache.put(1, _stat('a')))
+    self.assertEqual('a', file_cache.get(1).etag)
+    self.assertEqual(None, file_cache.get(2))
+
+  def testLocalTier(self):
+    file_cache.put(1, _stat('a'))
+    memcache.flush_all()
+    self.assertEqual('a', file_cache.get(1).etag)
+
+  def testMemcacheTier(self):
+    # another instance fills its local tier from memcache
+    file_cache.put(1, _stat('a'))
+    file_cache._local.clear()
+    self.assertEqual('a', file_cache.get(1).etag)
+    memcache.flush_all()
+    self.assertEqual('a', file_cache.get(1).etag)
+
+  def testReplace(self):
+    file_cache.put(1, _stat('a'))
+    self.assertTrue(file_cache.put(1, _stat('b')))
+    self.assertEqual('b', file_cache.get(1).etag)
+    file_cache._local.clear()
+    self.assertEqual('b', file_cache.get(1).etag)
+
+  def testInvalidate(self):
+    file_cache.put(1, _stat('a'))
+    file_cache.put(2, _stat('a'))
+    file_cache.invalidate_multi([1, 2])
+    self.assertEqual(None, file_cache.get(1))
+    self.assertEqual(None, file_cache.get(2))
+
+  def testStaleStatIsNotWrittenBack(self):
+    # a reader that got its stat before the invalidation can't cache it
+    file_cache.put(1, _stat('a'))
+    file_cache.invalidate(1)
+    self.assertFalse(file_cache.put(1, _stat('a')))
+    self.assertEqual(None, file_cache.get(1))
+
+  def testLocalTierIsBounded(self):
+    for file_id in range(file_cache._LOCAL_MAX_ENTRIES + 1):
+      file_cache._put_local(str(file_id), _stat('a'))
+    self.assertEqual(file_cache._LOCAL_MAX_ENTRIES, len(file_cache._local))
+    self.assertNotIn('0', file_cache._local)
+
+
+if __name__ == '__main__':
+  unittest.main()
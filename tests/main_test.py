@@ -0,0 +1,415 @@
+"""Tests for the request handlers of main.py.
+
+Requests go through the webapp2 app against the testbed stubs: files are
+written to the gcs stub and their GCSFile entries to the datastore stub.
+Files sent with send_blob are checked through the blobstore headers the
+runtime acts on, since the stubs don't serve the blob itself.
+"""
+
+import json
+import os
+import sys
+import types
+import unittest
+from email.utils import formatdate
+
+# as on the python27 runtime, where webapp is webapp2
+os.environ.setdefault('APPENGINE_RUNTIME', 'python27')
+
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+# secrets.py holds the app's keys and is not checked in
+if 'secrets' not in sys.modules:
+  _secrets = types.ModuleType('secrets')
+  _secrets.Google_Frontend = 'frontend secret'
+  sys.modules['secrets'] = _secrets
+
+import main
+import lib.cloudstorage as gcs
+from database import file_cache
+from database.file_deletes import FileDeletes
+from database.gcs_file import GCSFile
+from database.gcs_file_name import GCSFileName
+
+
+class _MainTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_app_identity_stub()
+    self.testbed.init_blobstore_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_urlfetch_stub()
+    ndb.get_context().clear_cache()
+    # file ids start over in every test, so no stat may outlive one
+    file_cache._local.clear()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def save_file(self, data, name='/bucket/folder/file.txt', content_type='text/plain'):
+    """Write a file to gcs and the database, returning its fileId."""
+    with gcs.open(name, 'w', content_type=content_type,
+                  options={'x-goog-meta-original-name': 'file.txt'}) as f:
+      f.write(data)
+    db_gcs_file = GCSFile.save_new(gcs_file_name=name, user_id='user id', user_name='user',
+                                   original_file_name='file.txt')
+    db_gcs_file.put()
+    GCSFileName.save_new(name, db_gcs_file.key.id()).put()
+    return db_gcs_file.key.id()
+
+  def get(self, file_id, **headers):
+    return main.app.get_response('/gcs?fileId=%s' % file_id, headers=headers.items())
+
+  def reply(self, response):
+    """The JSON of a render_json response."""
+    return json.loads(response.body.split('\n', 1)[1])
+
+  def upload(self, data, file_name='file.txt'):
+    return main.app.get_response('/gcs', POST={'file_input': (file_name, data), 'folderName': 'folder',
+                                               'userName': 'user', 'userId': 'user id'})
+
+
+class ParseRangeHeaderTest(unittest.TestCase):
+
+  def testNoRange(self):
+    self.assertEqual(None, main.parse_range_header(None, 100))
+    self.assertEqual(None, main.parse_range_header('items=0-1', 100))
+    self.assertEqual(None, main.parse_range_header('bytes=a-1', 100))
+    self.assertEqual(None, main.parse_range_header('bytes=5-1', 100))
+
+  def testRanges(self):
+    self.assertEqual([(0, 9)], main.parse_range_header('bytes=0-9', 100))
+    self.assertEqual([(90, 99)], main.parse_range_header('bytes=90-', 100))
+    self.assertEqual([(90, 99)], main.parse_range_header('bytes=-10', 100))
+    self.assertEqual([(0, 99)], main.parse_range_header('bytes=-1000', 100))
+    self.assertEqual([(50, 99)], main.parse_range_header('bytes=50-1000', 100))
+    self.assertEqual([(0, 0), (5, 9)], main.parse_range_header('bytes=0-0, 5-9', 100))
+
+  def testUnsatisfiable(self):
+    self.assertEqual([], main.parse_range_header('bytes=100-', 100))
+    self.assertEqual([], main.parse_range_header('bytes=100-200', 100))
+    self.assertEqual([], main.parse_range_header('bytes=-0', 100))
+    self.assertEqual([], main.parse_range_header('bytes=0-', 0))
+    self.assertEqual([(0, 9)], main.parse_range_header('bytes=100-, 0-9', 100))
+
+
+class GCSGetTest(_MainTestCase):
+
+  def testMissingFile(self):
+    self.assertEqual(404, self.get(1234).status_int)
+
+  def testWholeFile(self):
+    file_id = self.save_file('x' * 100)
+    response = self.get(file_id)
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(blobstore.create_gs_key('/gs/bucket/folder/file.txt'),
+                     response.headers[blobstore.BLOB_KEY_HEADER])
+    self.assertNotIn(blobstore.BLOB_RANGE_HEADER, response.headers)
+    self.assertEqual('text/plain', response.headers['Content-Type'])
+    self.assertEqual('attachment; filename=file.txt', response.headers['Content-Disposition'])
+
+  def testRange(self):
+    file_id = self.save_file('x' * 100)
+    response = self.get(file_id, Range='bytes=10-19')
+    self.assertEqual('bytes=10-19', response.headers[blobstore.BLOB_RANGE_HEADER])
+    response = self.get(file_id, Range='bytes=-10')
+    self.assertEqual('bytes=90-99', response.headers[blobstore.BLOB_RANGE_HEADER])
+
+  def testUnsatisfiableRange(self):
+    file_id = self.save_file('x' * 100)
+    for range_header in ('bytes=100-', 'bytes=200-300'):
+      response = self.get(file_id, Range=range_header)
+      self.assertEqual(416, response.status_int)
+      self.assertEqual('bytes */100', response.headers['Content-Range'])
+      self.assertNotIn(blobstore.BLOB_KEY_HEADER, response.headers)
+
+  def testIfRange(self):
+    file_id = self.save_file('x' * 100)
+    etag = self.get(file_id).headers['ETag']
+    response = self.get(file_id, Range='bytes=10-19', **{'If-Range': etag})
+    self.assertEqual('bytes=10-19', response.headers[blobstore.BLOB_RANGE_HEADER])
+    # a stale partial copy gets the whole file
+    response = self.get(file_id, Range='bytes=10-19', **{'If-Range': '"stale"'})
+    self.assertEqual(200, response.status_int)
+    self.assertIn(blobstore.BLOB_KEY_HEADER, response.headers)
+    self.assertNotIn(blobstore.BLOB_RANGE_HEADER, response.headers)
+
+  def testMultipleRanges(self):
+    data = ''.join(chr(ord('a') + i % 26) for i in range(100))
+    file_id = self.save_file(data)
+    response = self.get(file_id, Range='bytes=50-59, 0-9')
+    self.assertEqual(206, response.status_int)
+    self.assertNotIn(blobstore.BLOB_KEY_HEADER, response.headers)
+    content_type, boundary = response.headers['Content-Type'].split('; boundary=')
+    self.assertEqual('multipart/byteranges', content_type)
+    self.assertEqual(str(len(response.body)), response.headers['Content-Length'])
+    self.assertEqual(
+        '\r\n--%(b)s\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-9/100\r\n\r\n%(first)s'
+        '\r\n--%(b)s\r\nContent-Type: text/plain\r\nContent-Range: bytes 50-59/100\r\n\r\n%(second)s'
+        '\r\n--%(b)s--\r\n' % {'b': boundary, 'first': data[0:10], 'second': data[50:60]},
+        response.body)
+
+  def testRangesAreMerged(self):
+    file_id = self.save_file('x' * 100)
+    response = self.get(file_id, Range='bytes=10-19, 0-14, 20-29')
+    self.assertEqual('bytes=0-29', response.headers[blobstore.BLOB_RANGE_HEADER])
+
+  def testTooManyRanges(self):
+    file_id = self.save_file('x' * 100)
+    range_header = 'bytes=' + ', '.join('%d-%d' % (i * 2, i * 2) for i in range(main.MAX_RANGES + 1))
+    response = self.get(file_id, Range=range_header)
+    self.assertEqual(200, response.status_int)
+    self.assertIn(blobstore.BLOB_KEY_HEADER, response.headers)
+    self.assertNotIn(blobstore.BLOB_RANGE_HEADER, response.headers)
+
+
+class GCSCachedStatTest(_MainTestCase):
+
+  def testDownloadUsesCachedStat(self):
+    file_id = self.save_file('data')
+    self.get(file_id)
+    # neither the database nor gcs is asked again for a plain download
+    GCSFile.get(file_id).key.delete()
+    response = self.get(file_id)
+    self.assertEqual(200, response.status_int)
+    self.assertIn(blobstore.BLOB_KEY_HEADER, response.headers)
+
+  def testRangeRevalidatesCachedStat(self):
+    file_id = self.save_file('data')
+    old_etag = self.get(file_id).headers['ETag']
+    with gcs.open('/bucket/folder/file.txt', 'w', options={'x-goog-meta-original-name': 'file.txt'}) as f:
+      f.write('new data')
+    response = self.get(file_id, Range='bytes=4-7')
+    self.assertEqual('bytes=4-7', response.headers[blobstore.BLOB_RANGE_HEADER])
+    self.assertNotEqual(old_etag, response.headers['ETag'])
+    self.assertEqual(response.headers['ETag'], self.get(file_id).headers['ETag'])
+
+  def testUploadInvalidatesCachedStat(self):
+    file_id = self.reply(self.upload('data'))['id']
+    old_etag = self.get(file_id).headers['ETag']
+    self.upload('new data')
+    self.assertNotEqual(old_etag, self.get(file_id).headers['ETag'])
+
+  def testDeleteInvalidatesCachedStat(self):
+    file_id = self.save_file('data')
+    self.get(file_id)
+    main.app.get_response('/gcs?fileId=%d' % file_id, method='DELETE',
+                          headers=[('Firebase-User-Id', 'user id')])
+    self.assertEqual(404, self.get(file_id).status_int)
+
+  def testMissingObjectIsNotCached(self):
+    file_id = self.save_file('data')
+    self.get(file_id)
+    gcs.delete('/bucket/folder/file.txt')
+    # a partial request checks gcs, and the stale stat is dropped
+    self.assertEqual(404, self.get(file_id, Range='bytes=0-1').status_int)
+    self.assertEqual(None, file_cache.get(file_id))
+
+
+class GCSConditionalGetTest(_MainTestCase):
+
+  def testValidatorHeaders(self):
+    file_id = self.save_file('data')
+    stat = gcs.stat('/bucket/folder/file.txt')
+    response = self.get(file_id)
+    self.assertEqual('"%s"' % stat.etag, response.headers['ETag'])
+    self.assertEqual(formatdate(stat.st_ctime, usegmt=True), response.headers['Last-Modified'])
+
+  def testIfNoneMatch(self):
+    file_id = self.save_file('data')
+    etag = self.get(file_id).headers['ETag']
+    for if_none_match in (etag, 'W/' + etag, '"other", ' + etag, '*'):
+      response = self.get(file_id, **{'If-None-Match': if_none_match})
+      self.assertEqual(304, response.status_int)
+      self.assertEqual('', response.body)
+      self.assertNotIn(blobstore.BLOB_KEY_HEADER, response.headers)
+      self.assertEqual(etag, response.headers['ETag'])
+    response = self.get(file_id, **{'If-None-Match': '"other"'})
+    self.assertEqual(200, response.status_int)
+    self.assertIn(blobstore.BLOB_KEY_HEADER, response.headers)
+
+  def testIfModifiedSince(self):
+    file_id = self.save_file('data')
+    last_modified = self.get(file_id).headers['Last-Modified']
+    self.assertEqual(304, self.get(file_id, **{'If-Modified-Since': last_modified}).status_int)
+    self.assertEqual(200, self.get(file_id, **{
+        'If-Modified-Since': 'Mon, 20 Nov 1995 19:12:08 GMT'}).status_int)
+    self.assertEqual(200, self.get(file_id, **{'If-Modified-Since': 'yesterday'}).status_int)
+
+  def testIfNoneMatchWinsOverIfModifiedSince(self):
+    file_id = self.save_file('data')
+    last_modified = self.get(file_id).headers['Last-Modified']
+    response = self.get(file_id, **{'If-None-Match': '"other"', 'If-Modified-Since': last_modified})
+    self.assertEqual(200, response.status_int)
+
+
+class GCSUploadTest(_MainTestCase):
+
+  name = '/deepspace9-1134.appspot.com/folder/file.txt'
+
+  def legacy_file(self):
+    """Save a GCSFile the way it was before the GCSFileName index existed."""
+    db_gcs_file = GCSFile.save_new(gcs_file_name=self.name, user_id='user id', user_name='user',
+                                   original_file_name='file.txt')
+    db_gcs_file.put()
+    return db_gcs_file.key.id()
+
+  def testNewFile(self):
+    reply = self.reply(self.upload('data'))
+    self.assertEqual('success', reply['status'])
+    self.assertEqual(self.name, GCSFile.get(reply['id']).gcs_file_name)
+    self.assertEqual(reply['id'], GCSFileName.key_for(self.name).get().file_id)
+    with gcs.open(self.name) as f:
+      self.assertEqual('data', f.read())
+
+  def testReplacedFileKeepsItsId(self):
+    file_id = self.reply(self.upload('data'))['id']
+    self.assertEqual(file_id, self.reply(self.upload('new data'))['id'])
+    self.assertEqual(1, GCSFile.query().count())
+    with gcs.open(self.name) as f:
+      self.assertEqual('new data', f.read())
+
+  def testFileUploadedBeforeTheIndex(self):
+    with gcs.open(self.name, 'w') as f:
+      f.write('data')
+    file_id = self.legacy_file()
+    self.assertEqual(file_id, self.reply(self.upload('new data'))['id'])
+    self.assertEqual(file_id, GCSFileName.key_for(self.name).get().file_id)
+
+  def testStaleEntryOfNewFile(self):
+    # an entry left behind by a file that is no longer in gcs is neither
+    # reused nor looked up, so the lookup can't index it
+    stale_id = self.legacy_file()
+    lookups = []
+    get_by_gcs_file_name_async = GCSFile.get_by_gcs_file_name_async
+    self.addCleanup(setattr, GCSFile, 'get_by_gcs_file_name_async',
+                    GCSFile.__dict__['get_by_gcs_file_name_async'])
+    def record_lookup(gcs_file_name):
+      lookups.append(gcs_file_name)
+      return get_by_gcs_file_name_async(gcs_file_name)
+    GCSFile.get_by_gcs_file_name_async = staticmethod(record_lookup)
+    file_id = self.reply(self.upload('data'))['id']
+    self.assertEqual([], lookups)
+    self.assertNotEqual(stale_id, file_id)
+    self.assertEqual(file_id, GCSFileName.key_for(self.name).get().file_id)
+
+
+class GCSMultiUploadTest(_MainTestCase):
+
+  folder = '/deepspace9-1134.appspot.com/folder/'
+
+  def upload_files(self, files):
+    post = [('file_input', f) for f in files]
+    post += [('folderName', 'folder'), ('userName', 'user'), ('userId', 'user id')]
+    return main.app.get_response('/gcs-multi-upload', POST=post, content_type='multipart/form-data')
+
+  def testUpload(self):
+    file_id = self.reply(self.upload('old data', 'b.txt'))['id']
+    reply = self.reply(self.upload_files([('a.txt', 'a data'), ('b.txt', 'b data')]))
+    self.assertEqual(['a.txt', 'b.txt'], [f['name'] for f in reply['files']])
+    self.assertEqual(['success', 'success'], [f['status'] for f in reply['files']])
+    # a replaced file keeps its id
+    self.assertEqual(file_id, reply['files'][1]['id'])
+    for f, data in zip(reply['files'], ['a data', 'b data']):
+      db_gcs_file = GCSFile.get(f['id'])
+      self.assertEqual(self.folder + f['name'], db_gcs_file.gcs_file_name)
+      self.assertEqual(f['id'], GCSFileName.key_for(db_gcs_file.gcs_file_name).get().file_id)
+      with gcs.open(db_gcs_file.gcs_file_name) as gcs_file:
+        self.assertEqual(data, gcs_file.read())
+
+  def testFailedUpload(self):
+    gcs_open = gcs.open
+    def open_or_fail(filename, *args, **kwds):
+      if filename.endswith('/bad.txt'):
+        raise gcs.TransientError('failed')
+      return gcs_open(filename, *args, **kwds)
+    gcs.open = open_or_fail
+    self.addCleanup(setattr, gcs, 'open', gcs_open)
+
+    reply = self.reply(self.upload_files([('good.txt', 'data'), ('bad.txt', 'data')]))
+    self.assertEqual(['success', 'error'], [f['status'] for f in reply['files']])
+    self.assertNotIn('id', reply['files'][1])
+    # no entry is left pointing at the file that was never written
+    self.assertEqual([self.folder + 'good.txt'], [f.gcs_file_name for f in GCSFile.query()])
+    self.assertEqual(None, GCSFileName.key_for(self.folder + 'bad.txt').get())
+
+  def testBadRequests(self):
+    self.assertEqual(400, self.upload_files([]).status_int)
+    self.assertEqual(400, self.upload_files([('a.txt', 'a'), ('a.txt', 'b')]).status_int)
+    self.assertEqual(0, GCSFile.query().count())
+
+
+class GCSBatchDeleteTest(_MainTestCase):
+
+  def delete(self, file_ids, user_id='user id'):
+    headers = {'Firebase-User-Id': user_id} if user_id else {}
+    return main.app.get_response('/gcs-batch-delete', POST=[('fileId', str(i)) for i in file_ids],
+                                 headers=headers.items())
+
+  def testDelete(self):
+    first = self.save_file('first', '/bucket/folder/first.txt')
+    second = self.save_file('second', '/bucket/folder/second.txt')
+    kept = self.save_file('kept', '/bucket/folder/kept.txt')
+    response = self.delete([first, second, 1234, 'abc', '0%d' % kept])
+    self.assertEqual(200, response.status_int)
+    self.assertEqual({str(first): 'deleted', str(second): 'deleted', '1234': 'not_found',
+                      'abc': 'invalid', '0%d' % kept: 'invalid'}, self.reply(response)['results'])
+
+    self.assertEqual([None, None], GCSFile.get_multi([first, second]))
+    self.assertEqual(None, GCSFileName.key_for('/bucket/folder/first.txt').get())
+    self.assertRaises(gcs.NotFoundError, gcs.stat, '/bucket/folder/first.txt')
+    self.assertEqual(['/bucket/folder/first.txt', '/bucket/folder/second.txt'],
+                     sorted(f.gcs_file_name for f in FileDeletes.query()))
+    self.assertNotEqual(None, GCSFile.get(kept))
+    self.assertEqual(200, self.get(kept).status_int)
+
+  def testFileMissingFromGcs(self):
+    file_id = self.save_file('data')
+    gcs.delete('/bucket/folder/file.txt')
+    response = self.delete([file_id])
+    self.assertEqual({str(file_id): 'not_found'}, self.reply(response)['results'])
+    self.assertEqual(0, FileDeletes.query().count())
+
+  def testDeletedFileIsNotServedFromCache(self):
+    file_id = self.save_file('data')
+    self.assertEqual(200, self.get(file_id).status_int)
+    self.delete([file_id])
+    self.assertEqual(404, self.get(file_id).status_int)
+
+  def testBadRequests(self):
+    self.assertEqual(400, self.delete([]).status_int)
+    self.assertEqual(400, self.delete([1], user_id=None).status_int)
+    self.assertEqual(400, self.delete(range(1, main.MAX_BATCH_DELETE_IDS + 2)).status_int)
+
+
+class GCSDemoTest(_MainTestCase):
+
+  def testEchoesUpload(self):
+    response = main.app.get_response('/gcs-demo', POST={'file_input': ('file.txt', 'data'),
+                                                        'folderName': 'folder'})
+    self.assertEqual(200, response.status_int)
+    name = '/deepspace9-1134.appspot.com/folder/file.txt'
+    self.assertEqual(blobstore.create_gs_key('/gs' + name), response.headers[blobstore.BLOB_KEY_HEADER])
+    self.assertEqual('attachment; filename=file.txt', response.headers['Content-Disposition'])
+    self.assertEqual('', response.body)
+    with gcs.open(name) as f:
+      self.assertEqual('data', f.read())
+
+
+class CoalesceRangesTest(unittest.TestCase):
+
+  def testCoalesceRanges(self):
+    self.assertEqual([], main.coalesce_ranges([]))
+    self.assertEqual([(0, 9), (20, 29)], main.coalesce_ranges([(20, 29), (0, 9)]))
+    self.assertEqual([(0, 19)], main.coalesce_ranges([(10, 19), (0, 9)]))
+    self.assertEqual([(0, 29)], main.coalesce_ranges([(0, 29), (5, 10), (20, 25)]))
+
+
+
+if __name__ == '__main__':
+  unittest.main()
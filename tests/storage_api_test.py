@@ -0,0 +1,786 @@
+"""Tests for the buffering of ReadBuffer and StreamingBuffer.
+
+The buffers are given an in-memory fake of the storage api, so the requests
+they make can be checked as well as the data they read and write. The
+datastore and memcache stubs of the testbed back upload checkpoints.
+"""
+
+import gzip
+import os
+import random
+import re
+import shutil
+import StringIO
+import tempfile
+import unittest
+from xml.sax import saxutils
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from lib.cloudstorage import cloudstorage_api
+from lib.cloudstorage import errors
+from lib.cloudstorage import storage_api
+
+
+class _FakeStorageApi(object):
+  """In-memory stand-in for _StorageApi with the requests the buffers make.
+
+  Attributes:
+    objects: a dict of path to object content.
+    content_encodings: a dict of path to the content-encoding of an object.
+    calls: the requests made, as (method, path, range) tuples.
+    max_puts_in_flight: most upload PUTs that were pending at once.
+  """
+
+  def __init__(self):
+    self.objects = {}
+    self.content_encodings = {}
+    self.calls = []
+    self.max_puts_in_flight = 0
+    self._sessions = {}
+    self._puts_in_flight = 0
+
+  def requests(self, method):
+    return [call for call in self.calls if call[0] == method]
+
+  def _headers(self, path):
+    data = self.objects[path]
+    headers = {'etag': '"%d"' % hash(data),
+               'content-type': 'application/octet-stream',
+               'last-modified': 'Mon, 20 Nov 1995 19:12:08 GMT',
+               'x-goog-stored-content-length': str(len(data))}
+    if path in self.content_encodings:
+      headers['content-encoding'] = self.content_encodings[path]
+    return headers
+
+  @ndb.tasklet
+  def head_object_async(self, path, **kwds):
+    self.calls.append(('HEAD', path, None))
+    if path not in self.objects:
+      raise ndb.Return((404, {}, ''))
+    raise ndb.Return((200, self._headers(path), ''))
+
+  def head_object(self, path, **kwds):
+    return self.head_object_async(path, **kwds).get_result()
+
+  @ndb.tasklet
+  def get_object_async(self, path, headers=None, **kwds):
+    byte_range = (headers or {}).get('Range')
+    self.calls.append(('GET', path, byte_range))
+    if path not in self.objects:
+      raise ndb.Return((404, {}, ''))
+    data = self.objects[path]
+    resp_headers = self._headers(path)
+    if not byte_range:
+      raise ndb.Return((200, resp_headers, data))
+    start, end = [int(i) for i in re.match(r'bytes=(\d+)-(\d+)',
+                                           byte_range).groups()]
+    if start >= len(data):
+      raise ndb.Return((416, {}, ''))
+    end = min(end, len(data) - 1)
+    resp_headers['content-range'] = 'bytes %d-%d/%d' % (start, end, len(data))
+    raise ndb.Return((206, resp_headers, data[start:end + 1]))
+
+  def get_object(self, path, **kwds):
+    return self.get_object_async(path, **kwds).get_result()
+
+  @ndb.tasklet
+  def post_object_async(self, path, headers=None, **kwds):
+    self.calls.append(('POST', path, None))
+    token = 'upload_id=%d' % (len(self._sessions) + 1)
+    self._sessions['%s?%s' % (path, token)] = (path, [])
+    raise ndb.Return((201, {'location': 'https://storage%s?%s' % (path, token)},
+                      ''))
+
+  @ndb.tasklet
+  def put_object_async(self, path, payload='', headers=None, **kwds):
+    headers = headers or {}
+    content_range = headers.get('content-range')
+    self.calls.append(('PUT', path, content_range))
+    if path not in self._sessions:
+      self.objects[path] = payload
+      raise ndb.Return((200, {}, ''))
+
+    object_path, received = self._sessions[path]
+    committed = sum(len(data) for data in received)
+    match = re.match(r'bytes (\d+)-\d+/(\S+)', content_range)
+    if match is None:
+      file_len = content_range.split('/')[1]
+    else:
+      file_len = match.group(2)
+      if int(match.group(1)) != committed:
+        raise ndb.Return((400, {}, 'out of order'))
+      self._puts_in_flight += 1
+      self.max_puts_in_flight = max(self.max_puts_in_flight,
+                                    self._puts_in_flight)
+      # let the next chunk be sent while this one is pending
+      yield ndb.sleep(0)
+      self._puts_in_flight -= 1
+      received.append(payload)
+      committed += len(payload)
+
+    if file_len == '*':
+      resp_headers = {}
+      if committed:
+        resp_headers['range'] = 'bytes=0-%d' % (committed - 1)
+      raise ndb.Return((308, resp_headers, ''))
+    self.objects[object_path] = ''.join(received)
+    raise ndb.Return((200, {}, ''))
+
+  def put_object(self, path, **kwds):
+    return self.put_object_async(path, **kwds).get_result()
+
+  @ndb.tasklet
+  def delete_object_async(self, path, **kwds):
+    self.calls.append(('DELETE', path, None))
+    if self.objects.pop(path, None) is None:
+      raise ndb.Return((404, {}, ''))
+    raise ndb.Return((204, {}, ''))
+
+  def compose_object(self, file_list, destination_file, content_type,
+                     gcs_headers=None):
+    self.calls.append(('COMPOSE', destination_file, len(file_list)))
+    bucket = destination_file.split('/')[1]
+    self.objects[destination_file] = ''.join(
+        self.objects['/%s/%s' % (bucket, saxutils.unescape(f['Name']))]
+        for f in file_list)
+
+
+class _StorageTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().clear_cache()
+    self.api = _FakeStorageApi()
+    self.random = random.Random(0)
+    storage_api.set_block_cache(None)
+
+  def tearDown(self):
+    storage_api.set_block_cache(None)
+    self.testbed.deactivate()
+
+
+class ReadBufferTest(_StorageTestCase):
+
+  def open(self, data, **kwds):
+    self.api.objects['/bucket/file'] = data
+    return storage_api.ReadBuffer(self.api, '/bucket/file', buffer_size=1000,
+                                  max_request_size=3000, **kwds)
+
+  def testSeekInsideBufferMakesNoRequest(self):
+    data = os.urandom(10000)
+    f = self.open(data)
+    self.assertEqual(data[:10], f.read(10))
+    gets = len(self.api.requests('GET'))
+    f.seek(500)
+    self.assertEqual(data[500:600], f.read(100))
+    f.seek(5)
+    self.assertEqual(data[5:15], f.read(10))
+    self.assertEqual(gets, len(self.api.requests('GET')))
+
+  def testSeekIntoPrefetchedBuffer(self):
+    data = os.urandom(10000)
+    f = self.open(data)
+    f.read(10)
+    f.seek(1500)
+    self.assertEqual(data[1500:1510], f.read(10))
+    self.assertEqual(['bytes=0-999', 'bytes=1000-1999'],
+                     [call[2] for call in self.api.requests('GET')][:2])
+    self.assertNotIn('bytes=1500-2499',
+                     [call[2] for call in self.api.requests('GET')])
+
+  def testSeekBackIntoCachedSegment(self):
+    data = os.urandom(10000)
+    f = self.open(data)
+    f.read(10)
+    f.seek(1500)
+    f.read(10)
+    gets = len(self.api.requests('GET'))
+    f.seek(20)
+    self.assertEqual(data[20:30], f.read(10))
+    f.seek(1200)
+    self.assertEqual(data[1200:1210], f.read(10))
+    # both segments and the ones after them are cached
+    self.assertEqual(gets, len(self.api.requests('GET')))
+
+  def testSequentialReadsKeepNoSegments(self):
+    data = os.urandom(10000)
+    f = self.open(data)
+    for start in range(0, 10000, 100):
+      self.assertEqual(data[start:start + 100], f.read(100))
+    self.assertEqual({}, dict(f._segments))
+    gets = len(self.api.requests('GET'))
+    f.seek(0)
+    self.assertEqual(data[:10], f.read(10))
+    self.assertEqual('bytes=0-999', self.api.requests('GET')[gets][2])
+
+  def testRandomAccess(self):
+    data = os.urandom(10000)
+    f = self.open(data)
+    for _ in range(500):
+      offset = self.random.randint(0, 10000)
+      size = self.random.randint(0, 2500)
+      f.seek(offset)
+      self.assertEqual(data[offset:offset + size], f.read(size))
+
+  def testEmptyFile(self):
+    f = self.open('')
+    self.assertEqual('', f.read())
+    self.assertEqual('', f.read(10))
+    self.assertEqual('', f.readline())
+    self.assertEqual([], f.readlines())
+    self.assertEqual(0, f.readinto(bytearray(10)))
+    self.assertEqual(0, f.tell())
+
+  def testEof(self):
+    data = os.urandom(2000)
+    f = self.open(data)
+    self.assertEqual(data, f.read(2000))
+    self.assertEqual('', f.read(1))
+    self.assertEqual(0, f.readinto(bytearray(10)))
+    f.seek(-1, os.SEEK_END)
+    self.assertEqual(data[-1:], f.read())
+    f.seek(5000)
+    self.assertEqual(2000, f.tell())
+    self.assertEqual('', f.read())
+    f.seek(1990)
+    self.assertEqual(data[1990:], f.read(100))
+
+  def testOffsetPastEof(self):
+    data = os.urandom(100)
+    self.assertEqual('', self.open(data, offset=200).read())
+    calls = len(self.api.calls)
+    f = self.open(data, offset=200, lazy=True)
+    self.assertEqual(calls, len(self.api.calls))
+    self.assertEqual('', f.read())
+    self.assertEqual(100, f.tell())
+
+  def testReadlines(self):
+    data = ''.join(self.random.choice('ab\n') for _ in range(10000))
+    want = StringIO.StringIO(data).readlines()
+    self.assertEqual(want, self.open(data).readlines())
+    self.assertEqual(want, self.open(data).readlines(0))
+    f = self.open(data)
+    f.read(1)
+    self.assertEqual(StringIO.StringIO(data[1:]).readlines(), f.readlines())
+
+  def testReadlinesHint(self):
+    data = ''.join(self.random.choice('ab\n') for _ in range(10000))
+    want = StringIO.StringIO(data).readlines()
+    f = self.open(data)
+    batch = f.readlines(150)
+    # the rest of the buffer is split too, but no more
+    self.assertTrue(150 <= len(''.join(batch)) <= 1000 + len(want[0]))
+    batches = [batch]
+    while batch:
+      batch = f.readlines(150)
+      batches.append(batch)
+    self.assertEqual(want, sum(batches, []))
+
+  def testReadlinesCarriageReturn(self):
+    data = 'a\rb\nc\r\nd' * 500
+    want = StringIO.StringIO(data).readlines()
+    self.assertEqual(want, self.open(data).readlines())
+    self.assertEqual(want, list(self.open(data).iter_lines()))
+
+  def testReadlineAtBufferBoundary(self):
+    data = 'a' * 999 + '\n' + 'b' * 1500 + '\n' + 'c'
+    f = self.open(data)
+    self.assertEqual(['a' * 999 + '\n', 'b' * 1500 + '\n', 'c'],
+                     list(f.iter_lines()))
+    self.assertEqual('', f.readline())
+
+  def testReadintoAcrossSegments(self):
+    data = os.urandom(5000)
+    f = self.open(data)
+    self.assertEqual(data[:13], f.read(13))
+    view = bytearray(2500)
+    self.assertEqual(2500, f.readinto(view))
+    self.assertEqual(data[13:2513], str(view))
+    out = []
+    small = bytearray(333)
+    while True:
+      size = f.readinto(small)
+      if not size:
+        break
+      out.append(str(small[:size]))
+    self.assertEqual(data[2513:], ''.join(out))
+
+  def testBlockCache(self):
+    cache = storage_api.BlockCache(max_bytes=4000, block_size=1000)
+    storage_api.set_block_cache(cache)
+    data = os.urandom(1000)
+    self.assertEqual(data, self.open(data).read())
+    gets = len(self.api.requests('GET'))
+    self.assertEqual(data, self.open(data).read())
+    self.assertEqual(gets, len(self.api.requests('GET')))
+    self.assertEqual(1, cache.hits)
+
+  def testBlockCacheSkipsLargeFiles(self):
+    cache = storage_api.BlockCache(max_bytes=4000, block_size=1000)
+    storage_api.set_block_cache(cache)
+    small = os.urandom(1000)
+    self.open(small).read()
+    self.api.objects['/bucket/large'] = os.urandom(10000)
+    storage_api.ReadBuffer(self.api, '/bucket/large', buffer_size=1000,
+                           max_request_size=3000).read()
+    self.assertEqual(1000, cache.size)
+    gets = len(self.api.requests('GET'))
+    self.assertEqual(small, self.open(small).read())
+    self.assertEqual(gets, len(self.api.requests('GET')))
+
+  def testLargeFilesSpillToDisk(self):
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    disk = storage_api.DiskBlockCache(directory, max_bytes=100000,
+                                      block_size=1000, max_file_size=20000)
+    cache = storage_api.BlockCache(max_bytes=4000, block_size=1000,
+                                   spill=disk)
+    storage_api.set_block_cache(cache)
+    small = os.urandom(1000)
+    self.open(small).read()
+    large = os.urandom(10000)
+    self.api.objects['/bucket/large'] = large
+    storage_api.ReadBuffer(self.api, '/bucket/large', buffer_size=1000,
+                           max_request_size=3000).read()
+    # the large file's blocks went straight to disk
+    self.assertEqual(1000, cache.size)
+    self.assertEqual(10000, disk.size)
+
+    gets = len(self.api.requests('GET'))
+    self.assertEqual(large, storage_api.ReadBuffer(
+        self.api, '/bucket/large', buffer_size=1000,
+        max_request_size=3000).read())
+    self.assertEqual(small, self.open(small).read())
+    self.assertEqual(gets, len(self.api.requests('GET')))
+
+    huge = os.urandom(30000)
+    self.api.objects['/bucket/huge'] = huge
+    storage_api.ReadBuffer(self.api, '/bucket/huge', buffer_size=1000,
+                           max_request_size=3000).read()
+    self.assertEqual(1000, cache.size)
+    self.assertEqual(10000, disk.size)
+
+  def testReadintoAfterSeek(self):
+    data = os.urandom(5000)
+    f = self.open(data)
+    f.seek(100)
+    view = bytearray(10000)
+    self.assertEqual(4900, f.readinto(view))
+    self.assertEqual(data[100:], str(view[:4900]))
+
+  def testDownloadTo(self):
+    data = os.urandom(10000)
+    f = self.open(data)
+    self.assertEqual(data[:10], f.read(10))
+    out = StringIO.StringIO()
+    out.write('header')
+    self.assertEqual(9990, f.download_to(out, concurrency=3))
+    self.assertEqual('header' + data[10:], out.getvalue())
+    self.assertEqual(len('header' + data[10:]), out.tell())
+    self.assertEqual(10000, f.tell())
+    self.assertEqual('', f.read())
+    # every byte was fetched once
+    ranges = sorted(tuple(int(i) for i in call[2][len('bytes='):].split('-'))
+                    for call in self.api.requests('GET'))
+    self.assertEqual([(i, i + 999) for i in range(0, 10000, 1000)], ranges)
+
+  def testDownloadToStream(self):
+    class Stream(object):
+      def __init__(self):
+        self.chunks = []
+      def write(self, data):
+        self.chunks.append(data)
+    data = os.urandom(10000)
+    stream = Stream()
+    self.assertEqual(10000, self.open(data).download_to(stream, concurrency=4))
+    self.assertEqual(data, ''.join(stream.chunks))
+
+  def testDownloadToAfterSeek(self):
+    data = os.urandom(5000)
+    f = self.open(data)
+    f.seek(2500)
+    out = StringIO.StringIO()
+    self.assertEqual(2500, f.download_to(out))
+    self.assertEqual(data[2500:], out.getvalue())
+    f.seek(100)
+    self.assertEqual(data[100:200], f.read(100))
+
+  def testDownloadToAtEof(self):
+    f = self.open('')
+    out = StringIO.StringIO()
+    self.assertEqual(0, f.download_to(out))
+    self.assertEqual('', out.getvalue())
+
+  def testReadRanges(self):
+    data = os.urandom(10000)
+    f = self.open(data, lazy=True)
+    self.assertEqual([data[10:20], data[500:7000]],
+                     f.read_ranges([(10, 19), (500, 6999)]))
+    self.assertEqual([('GET', '/bucket/file', 'bytes=10-19'),
+                      ('GET', '/bucket/file', 'bytes=500-3499'),
+                      ('GET', '/bucket/file', 'bytes=3500-6499'),
+                      ('GET', '/bucket/file', 'bytes=6500-6999')],
+                     self.api.calls)
+    self.assertEqual(0, f.tell())
+    self.assertEqual(data[:10], f.read(10))
+
+  def testReadRangesOfChangedFile(self):
+    f = self.open(os.urandom(100), lazy=True)
+    f.read_ranges([(0, 9)])
+    self.api.objects['/bucket/file'] = os.urandom(100)
+    self.assertRaises(ValueError, f.read_ranges, [(0, 9)])
+
+
+
+class DiskBlockCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+
+  def testPutAndGet(self):
+    cache = storage_api.DiskBlockCache(self.directory, max_bytes=10000)
+    self.assertEqual(None, cache.get(('/bucket/file', 'etag', 0)))
+    cache.put(('/bucket/file', 'etag', 0), 'block')
+    block = cache.get(('/bucket/file', 'etag', 0))
+    self.assertEqual('block', block[:])
+    self.assertEqual('loc', block[1:4])
+    self.assertEqual(None, cache.get(('/bucket/file', 'other etag', 0)))
+    self.assertEqual((1, 2), (cache.hits, cache.misses))
+    self.assertEqual(5, cache.size)
+
+  def testEvictsLeastRecentlyUsed(self):
+    cache = storage_api.DiskBlockCache(self.directory, max_bytes=3000)
+    for index in range(3):
+      cache.put(('/bucket/file', 'etag', index), 'x' * 1000)
+    cache.get(('/bucket/file', 'etag', 0))
+    cache.put(('/bucket/file', 'etag', 3), 'x' * 1000)
+    self.assertEqual(3000, cache.size)
+    self.assertEqual(None, cache.get(('/bucket/file', 'etag', 1)))
+    self.assertNotEqual(None, cache.get(('/bucket/file', 'etag', 0)))
+    self.assertEqual(3, len(os.listdir(self.directory)))
+
+  def testKeepsBlocksAcrossInstances(self):
+    cache = storage_api.DiskBlockCache(self.directory, max_bytes=3000)
+    cache.put(('/bucket/file', 'etag', 0), 'block')
+    open(os.path.join(self.directory, 'partial.1.tmp'), 'wb').close()
+    cache = storage_api.DiskBlockCache(self.directory, max_bytes=3000)
+    self.assertEqual('block', cache.get(('/bucket/file', 'etag', 0))[:])
+    self.assertEqual(1, len(os.listdir(self.directory)))
+    cache.clear()
+    self.assertEqual([], os.listdir(self.directory))
+    self.assertEqual(None, cache.get(('/bucket/file', 'etag', 0)))
+
+  def testCacheFor(self):
+    disk = storage_api.DiskBlockCache(self.directory, max_bytes=4000)
+    self.assertIs(disk, disk.cache_for(1000))
+    self.assertEqual(None, disk.cache_for(1001))
+    cache = storage_api.BlockCache(max_bytes=400, spill=disk)
+    self.assertIs(cache, cache.cache_for(100))
+    self.assertIs(disk, cache.cache_for(101))
+    self.assertEqual(None, cache.cache_for(1001))
+
+
+def _gzip(data):
+  out = StringIO.StringIO()
+  with gzip.GzipFile(fileobj=out, mode='wb') as f:
+    f.write(data)
+  return out.getvalue()
+
+
+class GzipReadBufferTest(_StorageTestCase):
+
+  def open(self, data, content_encoding='gzip'):
+    self.api.objects['/bucket/file'] = data
+    if content_encoding:
+      self.api.content_encodings['/bucket/file'] = content_encoding
+    raw = storage_api.ReadBuffer(self.api, '/bucket/file', buffer_size=1000,
+                                 max_request_size=3000)
+    return storage_api.GzipReadBuffer(raw, chunk_size=500)
+
+  def lines(self, count):
+    return ''.join('line %d %s\n' % (i, self.random.random())
+                   for i in range(count))
+
+  def testRead(self):
+    data = self.lines(3000)
+    f = self.open(_gzip(data))
+    self.assertEqual(data[:10], f.read(10))
+    self.assertEqual(data[10:], f.read())
+    self.assertEqual(len(data), f.tell())
+    self.assertEqual('', f.read())
+
+  def testReadlines(self):
+    data = self.lines(3000)
+    self.assertEqual(data.splitlines(True), list(self.open(_gzip(data))))
+
+  def testMultipleMembers(self):
+    first = self.lines(1000)
+    second = self.lines(1000)
+    f = self.open(_gzip(first) + _gzip(second) + '\0' * 100)
+    self.assertEqual(first + second, f.read())
+
+  def testEmptyMember(self):
+    self.assertEqual('', self.open(_gzip('')).read())
+    self.assertEqual('', self.open('').read())
+
+  def testTruncated(self):
+    data = _gzip(self.lines(3000))
+    self.assertRaises(IOError, self.open(data[:-5000]).read)
+    self.assertRaises(IOError, self.open(data[:-1]).read)
+    self.assertRaises(IOError, self.open(data[:10]).read)
+
+  def testTruncatedSecondMember(self):
+    data = _gzip(self.lines(10)) + _gzip(self.lines(10))
+    self.assertRaises(IOError, self.open(data[:-4]).read)
+
+  def testNotGzip(self):
+    data = _gzip(self.lines(100))
+    self.assertEqual(data, self.open(data, content_encoding=None).read())
+    text = self.lines(100)
+    self.assertEqual(text, self.open(text, content_encoding=None).read())
+
+
+class StreamingBufferTest(_StorageTestCase):
+
+  def open(self, **kwds):
+    return storage_api.StreamingBuffer(self.api, '/bucket/file', **kwds)
+
+  def testSmallFileIsOneRequest(self):
+    data = os.urandom(10)
+    f = self.open(content_type='text/plain')
+    f.write(data)
+    f.close()
+    self.assertEqual(data, self.api.objects['/bucket/file'])
+    self.assertEqual([('PUT', '/bucket/file', 'bytes 0-9/10')], self.api.calls)
+
+  def testEmptyFileIsOneRequest(self):
+    self.open().close()
+    self.assertEqual('', self.api.objects['/bucket/file'])
+    self.assertEqual([('PUT', '/bucket/file', 'bytes */0')], self.api.calls)
+
+  def testSmallFileHasNoContentRangeOnGcs(self):
+    os.environ['SERVER_SOFTWARE'] = 'Google App Engine/1.9.88'
+    try:
+      f = self.open()
+      f.write('data')
+      f.close()
+    finally:
+      del os.environ['SERVER_SOFTWARE']
+    self.assertEqual([('PUT', '/bucket/file', None)], self.api.calls)
+
+  def testSingleRequestThreshold(self):
+    size = storage_api.StreamingBuffer._single_request_size
+    data = os.urandom(size)
+    f = self.open()
+    f.write(data)
+    f.close()
+    self.assertEqual(data, self.api.objects['/bucket/file'])
+    self.assertEqual(['PUT'], [call[0] for call in self.api.calls])
+
+    self.api.calls = []
+    data = os.urandom(size + 1)
+    f = self.open()
+    f.write(data)
+    f.close()
+    self.assertEqual(data, self.api.objects['/bucket/file'])
+    self.assertEqual(['POST', 'PUT'], [call[0] for call in self.api.calls])
+
+  def testFlushStartsUpload(self):
+    data = os.urandom(storage_api.StreamingBuffer._blocksize + 10)
+    f = self.open()
+    f.write(data)
+    f.flush()
+    self.assertEqual(['POST', 'PUT'], [call[0] for call in self.api.calls])
+    f.close()
+    self.assertEqual(data, self.api.objects['/bucket/file'])
+
+  def testOnePutInFlight(self):
+    flushsize = storage_api.StreamingBuffer._flushsize
+    data = os.urandom(5 * flushsize + 100)
+    f = self.open()
+    for start in range(0, len(data), 100000):
+      f.write(data[start:start + 100000])
+    f.close()
+    self.assertEqual(data, self.api.objects['/bucket/file'])
+    self.assertEqual(1, self.api.max_puts_in_flight)
+    ranges = [call[2] for call in self.api.requests('PUT')]
+    self.assertEqual('bytes 0-%d/*' % (flushsize - 1), ranges[0])
+    self.assertTrue(ranges[-1].endswith('/%d' % len(data)))
+
+  def testOnePutInFlightAsync(self):
+    data = os.urandom(3 * storage_api.StreamingBuffer._flushsize)
+    f = self.open()
+    f.write_async(data).get_result()
+    f.close_async().get_result()
+    self.assertEqual(data, self.api.objects['/bucket/file'])
+    self.assertEqual(1, self.api.max_puts_in_flight)
+
+  def testWriteBufferObjects(self):
+    data = os.urandom(3000)
+    f = self.open()
+    f.write(bytearray(data[:1000]))
+    f.write(memoryview(data)[1000:2000])
+    f.write(buffer(data, 2000))
+    f.close()
+    self.assertEqual(data, self.api.objects['/bucket/file'])
+    self.assertRaises(TypeError, self.open().write, u'text')
+
+  def testCheckpointAndResume(self):
+    blocksize = storage_api.StreamingBuffer._blocksize
+    data = os.urandom(3 * blocksize)
+    f = self.open()
+    f.write(data[:blocksize + 100])
+    self.assertEqual(blocksize, f.checkpoint('upload'))
+
+    f = storage_api.StreamingBuffer.resume(self.api, 'upload')
+    self.assertEqual(blocksize, f.tell())
+    f.write(data[f.tell():])
+    f.close()
+    self.assertEqual(data, self.api.objects['/bucket/file'])
+    self.assertEqual(None, storage_api._AE_UploadCheckpoint_.get_by_id(
+        'upload', use_cache=False))
+
+  def testCheckpointBeforeAnyFlush(self):
+    data = os.urandom(100)
+    f = self.open()
+    f.write(data)
+    self.assertEqual(0, f.checkpoint('upload', use_datastore=False))
+    f = storage_api.StreamingBuffer.resume(self.api, 'upload',
+                                           use_datastore=False)
+    self.assertEqual(0, f.tell())
+    f.write(data)
+    f.close()
+    self.assertEqual(data, self.api.objects['/bucket/file'])
+
+  def testResumeMissingCheckpoint(self):
+    self.assertRaises(errors.NotFoundError,
+                      storage_api.StreamingBuffer.resume, self.api, 'missing')
+
+
+class ParallelStreamingBufferTest(_StorageTestCase):
+
+  def open(self, **kwds):
+    return storage_api.ParallelStreamingBuffer(self.api, '/bucket/large',
+                                               parallel=2, part_size=1000,
+                                               **kwds)
+
+  def write(self, f, data):
+    for i in range(0, len(data), 300):
+      f.write(data[i:i + 300])
+
+  def testComposesParts(self):
+    data = os.urandom(3500)
+    f = self.open()
+    self.write(f, data)
+    self.assertEqual(3500, f.tell())
+    f.close()
+    self.assertEqual(data, self.api.objects['/bucket/large'])
+    self.assertEqual([('COMPOSE', '/bucket/large', 4)],
+                     self.api.requests('COMPOSE'))
+    # the parts are gone
+    self.assertEqual(['/bucket/large'], self.api.objects.keys())
+    self.assertEqual(4, len(self.api.requests('DELETE')))
+
+  def testWholePartsOnly(self):
+    data = os.urandom(3000)
+    with self.open() as f:
+      self.write(f, data)
+    self.assertEqual(data, self.api.objects['/bucket/large'])
+    self.assertEqual([('COMPOSE', '/bucket/large', 3)],
+                     self.api.requests('COMPOSE'))
+
+  def testSmallFileIsUploadedDirectly(self):
+    with self.open() as f:
+      f.write('small')
+    self.assertEqual({'/bucket/large': 'small'}, self.api.objects)
+    self.assertEqual([], self.api.requests('COMPOSE'))
+
+  def testIntermediateComposites(self):
+    data = os.urandom(10000)
+    f = self.open()
+    f._max_compose = 4
+    self.write(f, data)
+    f.close()
+    self.assertEqual(data, self.api.objects['/bucket/large'])
+    self.assertEqual([4, 4, 2, 3],
+                     [call[2] for call in self.api.requests('COMPOSE')])
+    self.assertEqual(['/bucket/large'], self.api.objects.keys())
+
+  def testTooManyParts(self):
+    f = self.open()
+    f._max_parts = 2
+    self.assertRaises(ValueError, self.write, f, os.urandom(3001))
+    self.assertTrue(f.closed)
+    self.assertEqual({}, self.api.objects)
+
+  def testErrorDeletesParts(self):
+    try:
+      with self.open() as f:
+        self.write(f, os.urandom(2500))
+        raise RuntimeError()
+    except RuntimeError:
+      pass
+    self.assertEqual({}, self.api.objects)
+    self.assertRaises(IOError, f.write, 'data')
+
+
+class DevAppserverStubTest(_StorageTestCase):
+  """Uploads through the real storage api against the dev appserver stub."""
+
+  def setUp(self):
+    super(DevAppserverStubTest, self).setUp()
+    self.testbed.init_app_identity_stub()
+    self.testbed.init_blobstore_stub()
+    self.testbed.init_urlfetch_stub()
+
+  def assertObject(self, data, filename, content_type):
+    with cloudstorage_api.open(filename) as f:
+      self.assertEqual(data, f.read())
+    self.assertEqual(content_type, cloudstorage_api.stat(filename).content_type)
+
+  def testSmallFile(self):
+    with cloudstorage_api.open('/bucket/small', 'w',
+                               content_type='text/plain') as f:
+      f.write('small')
+    self.assertObject('small', '/bucket/small', 'text/plain')
+
+  def testEmptyFile(self):
+    cloudstorage_api.open('/bucket/empty', 'w', content_type='text/plain').close()
+    self.assertObject('', '/bucket/empty', 'text/plain')
+
+  def testLargeFile(self):
+    data = os.urandom(storage_api.StreamingBuffer._single_request_size + 1)
+    with cloudstorage_api.open('/bucket/large', 'w',
+                               content_type='text/plain') as f:
+      f.write(data)
+    self.assertObject(data, '/bucket/large', 'text/plain')
+
+  def testDownloadTo(self):
+    data = os.urandom(storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE * 2 + 10)
+    with cloudstorage_api.open('/bucket/large', 'w') as f:
+      f.write(data)
+    directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, directory)
+    path = os.path.join(directory, 'large')
+    self.assertEqual(len(data), cloudstorage_api.download_to('/bucket/large', path))
+    with open(path, 'rb') as f:
+      self.assertEqual(data, f.read())
+
+  def testWriteObject(self):
+    cloudstorage_api.write_object('/bucket/object', 'data', 'text/plain',
+                                  {'x-goog-meta-foo': 'foo'})
+    self.assertObject('data', '/bucket/object', 'text/plain')
+    self.assertEqual('foo', cloudstorage_api.stat('/bucket/object').metadata[
+        'x-goog-meta-foo'])
+    cloudstorage_api.write_object('/bucket/object', '')
+    self.assertObject('', '/bucket/object', 'application/octet-stream')
+
+
+if __name__ == '__main__':
+  unittest.main()